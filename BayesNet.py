@@ -48,6 +48,30 @@ the following functionalities:
 
 import json
 
+import array
+
+import itertools
+
+import csv
+
+import multiprocessing
+
+import multiprocessing.pool
+
+import time
+
+import collections
+
+import heapq
+
+import weakref
+
+import math
+
+import cPickle
+
+import numpy as np
+
 import networkx as nx
 
 import matplotlib.pylab as plt
@@ -92,8 +116,16 @@ def reset(bn):
 
     a Bayesian network to its original configuration with no nodes"""
 
+    for node in bn.nodes:
+
+        node.unwatch(bn)
+
     bn.nodes=[]
 
+    bn.version += 1
+
+    bn._children = None
+
     
 def display(bn):
 
@@ -231,6 +263,1745 @@ def normalize(dist):
 
 
 
+class LRUCache(object):
+    """A dictionary holding at most maxsize entries, which evicts the least
+    recently used entry when full and counts lookup hits and misses. The
+    cache can be tied to a model key so that it empties itself when the
+    model it was filled from changes."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.model = None
+
+    def get(self, key, default=None):
+        """This method returns the value stored under key, marking it as
+        the most recently used, or default when it is not cached"""
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """This method stores value under key, evicting the least recently
+        used entry if the cache is full"""
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def validate(self, model):
+        """This method empties the cache when model differs from the model
+        key it was last validated against"""
+        if self.model != model:
+            self.entries.clear()
+            self.model = model
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """This method returns a dict with the size, hit and miss counts and
+        hit rate of the cache"""
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses,
+                'hitrate': float(self.hits) / lookups if lookups else 0.0}
+
+
+
+class Factor(object):
+    """A table of non-negative numbers over a set of discrete variables, used
+    as the unit of work by the inference engines. The table is a dense NumPy
+    array with one axis per variable, in the order of the variables list;
+    domains maps every variable to its list of values."""
+    def __init__(self, variables, domains, values):
+        self.variables = list(variables)
+        self.domains = domains
+        self.values = np.asarray(values, dtype=float)
+
+    def _aligned(self, variables):
+        """Returns the table transposed and reshaped so that it broadcasts
+        against a table whose axes follow the given variables"""
+        order = sorted(range(len(self.variables)),
+                       key=lambda i: variables.index(self.variables[i]))
+        shape = [self.values.shape[self.variables.index(v)]
+                 if v in self.variables else 1 for v in variables]
+        return self.values.transpose(order).reshape(shape)
+
+    def product(self, other):
+        """This method returns the pointwise product of the factor with
+        another factor, defined over the union of their variables"""
+        variables = self.variables + [v for v in other.variables
+                                      if v not in self.variables]
+        if self.domains is other.domains:
+            domains = self.domains
+        else:
+            domains = dict([(v, self.domains[v]) for v in self.variables])
+            domains.update([(v, other.domains[v]) for v in other.variables])
+        values = self._aligned(variables) * other._aligned(variables)
+        return Factor(variables, domains, values)
+
+    def marginalize(self, variables):
+        """This method returns a new factor with the given variables summed
+        out"""
+        axes = tuple([self.variables.index(v) for v in variables
+                      if v in self.variables])
+        return Factor([v for v in self.variables if v not in variables],
+                      self.domains, self.values.sum(axis=axes))
+
+    def sum_out(self, var):
+        """This method returns a new factor with the given variable summed
+        out"""
+        return self.marginalize([var])
+
+    def reduce(self, e):
+        """This method returns a new factor with the variables observed in the
+        evidence dict e fixed to their values and dropped from the factor"""
+        index = []
+        variables = []
+        for v in self.variables:
+            if v in e:
+                index.append(list(self.domains[v]).index(e[v]))
+            else:
+                index.append(slice(None))
+                variables.append(v)
+        return Factor(variables, self.domains, self.values[tuple(index)])
+
+    def max_out(self, var):
+        """This method returns a new factor with the given variable maximized
+        out, together with a factor over the same remaining variables
+        holding the index of the maximizing value"""
+        i = self.variables.index(var)
+        remaining = cut(self.variables, var)
+        return (Factor(remaining, self.domains, self.values.max(axis=i)),
+                Factor(remaining, self.domains, self.values.argmax(axis=i)))
+
+    def normalize(self):
+        """This method returns a new factor whose entries sum to 1. A factor
+        that sums to 0 is returned unchanged."""
+        total = self.values.sum()
+        if total == 0:
+            return self
+        return Factor(self.variables, self.domains, self.values / total)
+
+    def toDist(self):
+        """This method returns a one variable factor as a dictionary of
+        value:probability pairs"""
+        var = self.variables[0]
+        return dict(zip(self.domains[var], self.values.tolist()))
+
+
+
+def elimination_order(factors, hidden, heuristic='min-fill'):
+    """Returns the variables in hidden in a greedy elimination order for the
+    interaction graph of the factors, choosing the cheapest variable by
+    'min-degree', 'min-fill' or 'weighted-min-fill' at each step, with ties
+    broken by name."""
+    if heuristic not in ('min-fill', 'min-degree', 'weighted-min-fill'):
+        raise ValueError("Unknown elimination heuristic " + str(heuristic))
+    size = {}
+    neighbours = {}
+    for f in factors:
+        for v in f.variables:
+            size[v] = len(f.domains[v])
+            neighbours.setdefault(v, set()).update(f.variables)
+    for v in neighbours:
+        neighbours[v].discard(v)
+    remaining = set([v for v in hidden if v in neighbours])
+
+    def cost(v):
+        nb = neighbours[v]
+        if heuristic == 'min-degree':
+            return len(nb)
+        fill = 0
+        nb = sorted(nb)
+        for i, a in enumerate(nb):
+            for b in nb[i+1:]:
+                if b not in neighbours[a]:
+                    fill += 1 if heuristic == 'min-fill' else size[a] * size[b]
+        return fill
+    heap = [(cost(v), v) for v in remaining]
+    heapq.heapify(heap)
+    current = dict([(v, c) for c, v in heap])
+    order = [v for v in hidden if v not in neighbours]
+    while heap:
+        c, Y = heapq.heappop(heap)
+        if Y not in remaining or current[Y] != c:
+            continue
+        remaining.discard(Y)
+        order.append(Y)
+        nb = neighbours.pop(Y)
+        for v in nb:
+            neighbours[v].update(nb)
+            neighbours[v].discard(v)
+            neighbours[v].discard(Y)
+        affected = set(nb)
+        if heuristic != 'min-degree':
+            for v in nb:
+                affected.update(neighbours[v])
+        for v in affected & remaining:
+            c = cost(v)
+            if c != current[v]:
+                current[v] = c
+                heapq.heappush(heap, (c, v))
+    return order
+
+
+
+BATCH = '<batch>'
+
+
+def encode_levels(column, levels, grow=False):
+    """Returns the values in column as a NumPy array of integer codes into
+    levels, with -1 for None, NaN and empty strings. Values are matched
+    against the levels, then by their string form; integer columns hold
+    codes already unless the levels are integers. Unknown values and codes
+    raise a ValueError, unless grow is True and they can be added."""
+    column = np.asarray(column)
+    integer = column.dtype.kind in 'iu'
+    if integer and not (levels and all([
+            isinstance(l, (int, long, np.integer)) and
+            not isinstance(l, bool) for l in levels])):
+        column = column.astype(int)
+        if grow and not levels and len(column):
+            levels.extend(range(max(column.max() + 1, 0)))
+        bad = (column < -1) | (column >= len(levels))
+        if bad.any():
+            raise ValueError("Code " + str(column[bad][0]) +
+                             " is out of range for levels " + str(levels))
+        return column
+    if not integer:
+        column = column.astype(object)
+    index = dict([(l, i) for i, l in enumerate(levels)])
+    names = dict([(str(l), i) for i, l in enumerate(levels)])
+    uniques, inverse = np.unique(column, return_inverse=True)
+    lookup = np.empty(len(uniques), dtype=int)
+    for i, u in enumerate(uniques):
+        if integer:
+            u = int(u)
+        if u in index:
+            lookup[i] = index[u]
+        elif integer and u == -1:
+            lookup[i] = -1
+        elif not integer and (u is None or u != u or
+                              str(u) in ('None', 'nan', '')):
+            lookup[i] = -1
+        elif not integer and str(u) in names:
+            lookup[i] = names[str(u)]
+        elif grow:
+            index[u] = names[str(u)] = lookup[i] = len(levels)
+            levels.append(u)
+        else:
+            raise ValueError("Unknown value " + str(u) + " among " +
+                             str(levels))
+    return lookup[inverse]
+
+
+def read_csv_chunks(filename, chunkSize=100000):
+    """Generates the rows of a CSV file with a header row as dicts mapping
+    column names to NumPy arrays of at most chunkSize string values"""
+    f = open(filename, 'rb')
+    try:
+        reader = csv.reader(f)
+        header = reader.next()
+        while True:
+            rows = list(itertools.islice(reader, chunkSize))
+            if not rows:
+                break
+            columns = zip(*rows)
+            yield dict([(name, np.array(columns[i], dtype=object))
+                        for i, name in enumerate(header)])
+    finally:
+        f.close()
+
+
+def encode_table(data, columns=None, levels=None):
+    """Returns the code arrays of the columns of data, with -1 for missing
+    entries, their lists of values and the number of records. data is a CSV
+    file name, a dict of columns or a 2-D array of rows named by columns;
+    empty levels, or all of them when levels is None, come from the data."""
+    if isinstance(data, basestring):
+        chunks = read_csv_chunks(data)
+    elif isinstance(data, dict):
+        chunks = [data]
+    else:
+        if columns is None:
+            raise ValueError("Column names are required for array data")
+        rows = np.asarray(data)
+        chunks = [dict([(c, rows[:, i]) for i, c in enumerate(columns)])]
+    parts = {}
+    fixed = None
+    for chunk in chunks:
+        if levels is None:
+            levels = dict([(str(v), []) for v in chunk])
+        if fixed is None:
+            fixed = set([v for v in levels if levels[v]])
+        for v in chunk:
+            name = str(v)
+            if name in levels:
+                parts.setdefault(name, []).append(
+                    encode_levels(chunk[v], levels[name], name not in fixed))
+    codes = dict([(v, np.concatenate(c)) for v, c in parts.items()])
+    for v, c in codes.items():
+        if v not in fixed and len(c) and c.max() >= len(levels[v]):
+            levels[v].extend(range(len(levels[v]), c.max() + 1))
+    n = max([len(c) for c in codes.values()] + [0])
+    return codes, levels if levels is not None else {}, n
+
+
+def family_index(codes, sizes):
+    """Returns the mixed-radix index of every row of a list of code arrays,
+    the last array varying fastest, and a mask of the rows in which no code
+    is missing"""
+    index = np.zeros(len(codes[0]), dtype=np.int64)
+    valid = np.ones(len(codes[0]), dtype=bool)
+    for c, size in zip(codes, sizes):
+        index = index * size + np.maximum(c, 0)
+        valid &= c >= 0
+    return index, valid
+
+
+def evidence_indicators(codes, size):
+    """Returns an array with one row per code holding the indicator vector of
+    that code over size values; rows for negative codes are all ones"""
+    codes = np.asarray(codes)
+    indicators = np.ones((len(codes), size))
+    observed = np.nonzero(codes >= 0)[0]
+    indicators[observed] = 0.0
+    indicators[observed, codes[observed]] = 1.0
+    return indicators
+
+
+def eliminate(factors, order, batch=None):
+    """Sums the variables in order out of the product of the factors and
+    returns the product of what is left. Factors over the batch variable are
+    rescaled row by row against underflow, so the result is only
+    proportional to the true values within each row."""
+    factors = list(factors)
+    for Y in order:
+        related = [f for f in factors if Y in f.variables]
+        if not related:
+            continue
+        factors = [f for f in factors if Y not in f.variables]
+        joint = related[0]
+        for f in related[1:]:
+            joint = joint.product(f)
+        joint = joint.sum_out(Y)
+        if batch in joint.variables and len(joint.variables) > 1:
+            axes = tuple([i for i, v in enumerate(joint.variables)
+                          if v != batch])
+            scale = joint.values.max(axis=axes, keepdims=True)
+            scale[scale == 0] = 1.0
+            joint = Factor(joint.variables, joint.domains,
+                           joint.values / scale)
+        factors.append(joint)
+    result = factors[0]
+    for f in factors[1:]:
+        result = result.product(f)
+    return result
+
+
+
+def max_product(factors, sumOrder, maxOrder, batch=None):
+    """Sums the variables in sumOrder and then maximizes the variables in
+    maxOrder out of the product of the factors, and returns the maximizing
+    value index of every variable in maxOrder, found by backtracking, with
+    the maximal value. Over a batch axis both are arrays over the records."""
+    factors = list(factors)
+    if not factors:
+        return {}, 1.0
+    logScale = 0.0
+    argmaxes = []
+    for step, Y in enumerate(list(sumOrder) + list(maxOrder)):
+        related = [f for f in factors if Y in f.variables]
+        if not related:
+            continue
+        factors = [f for f in factors if Y not in f.variables]
+        joint = related[0]
+        for f in related[1:]:
+            joint = joint.product(f)
+        if step < len(sumOrder):
+            joint = joint.sum_out(Y)
+        else:
+            joint, argmax = joint.max_out(Y)
+            argmaxes.append((Y, argmax))
+        if batch in joint.variables and len(joint.variables) > 1:
+            axes = tuple([i for i, v in enumerate(joint.variables)
+                          if v != batch])
+            scale = joint.values.max(axis=axes, keepdims=True)
+            scale[scale == 0] = 1.0
+            joint = Factor(joint.variables, joint.domains,
+                           joint.values / scale)
+            logScale = logScale + np.log(scale).ravel()
+        factors.append(joint)
+    result = factors[0]
+    for f in factors[1:]:
+        result = result.product(f)
+    assignment = {}
+    if batch is not None:
+        assignment[batch] = np.arange(len(result.domains[batch]))
+        value = result._aligned([batch]).ravel()
+    else:
+        value = float(result.values)
+    for Y, argmax in reversed(argmaxes):
+        index = tuple([assignment[v] for v in argmax.variables])
+        assignment[Y] = np.asarray(argmax.values[index]).astype(int)
+    assignment.pop(batch, None)
+    with np.errstate(divide='ignore'):
+        return assignment, np.exp(np.log(value) + logScale)
+
+
+
+class JunctionTree(object):
+    """A junction tree compiled from the CPT factors of a Bayesian network by
+    triangulating the moral graph in the given elimination order. One
+    Shafer-Shenoy collect and distribute pass calibrates every clique."""
+    def __init__(self, factors, order):
+        self.domains = {}
+        for f in factors:
+            for v in f.variables:
+                self.domains[v] = f.domains[v]
+        neighbours = dict([(v, set()) for v in self.domains])
+        for f in factors:
+            for v in f.variables:
+                neighbours[v].update(f.variables)
+        position = dict([(v, i) for i, v in enumerate(order)])
+        cliques = []
+        parent = []
+        for Y in order:
+            nb = neighbours.pop(Y)
+            nb.discard(Y)
+            for v in nb:
+                neighbours[v].update(nb)
+                neighbours[v].discard(v)
+                neighbours[v].discard(Y)
+            cliques.append(set(nb) | set([Y]))
+            parent.append(position[min(nb, key=position.get)] if nb else None)
+        rep = list(range(len(cliques)))
+
+        def find(i):
+            while i is not None and rep[i] != i:
+                rep[i] = rep[rep[i]]
+                i = rep[i]
+            return i
+        for i in range(len(cliques)):
+            p = find(parent[i])
+            while p is not None and cliques[p] <= cliques[i]:
+                rep[p] = i
+                p = find(parent[p])
+            parent[i] = p
+        alive = [i for i in range(len(cliques)) if rep[i] == i]
+        index = dict([(i, n) for n, i in enumerate(alive)])
+        self.cliques = [sorted(cliques[i], key=position.get) for i in alive]
+        self.neighbours = [[] for i in alive]
+        for i in alive:
+            if parent[i] is not None:
+                p = index[find(parent[i])]
+                self.neighbours[index[i]].append(p)
+                self.neighbours[p].append(index[i])
+        self.home = dict([(v, index[find(position[v])]) for v in order])
+        self.potentials = [self._ones(c) for c in self.cliques]
+        self.assigned = []
+        for f in factors:
+            first = min(f.variables, key=position.get)
+            c = self.home[first]
+            self.potentials[c] = self.potentials[c].product(f)
+            self.assigned.append(c)
+        self.roots = []
+        seen = set()
+        for root in range(len(self.cliques)):
+            if root not in seen:
+                self.roots.append(root)
+                stack = [root]
+                seen.add(root)
+                while stack:
+                    for k in self.neighbours[stack.pop()]:
+                        if k not in seen:
+                            seen.add(k)
+                            stack.append(k)
+        self.evidence = None
+        self.likelihoods = {}
+        self.entered = {}
+        self.messages = {}
+        self.scales = {}
+        self.beliefs = {}
+        self.logNorms = {}
+
+    def _ones(self, variables):
+        return Factor(variables, self.domains,
+                      np.ones([len(self.domains[v]) for v in variables]))
+
+    def _potential(self, i):
+        """Returns the clique potential multiplied by the indicators of the
+        evidence variables and the likelihood factors whose home is the
+        clique"""
+        if i not in self.entered:
+            f = self.potentials[i]
+            for v, value in (self.evidence or {}).items():
+                if self.home.get(v) == i:
+                    indicator = np.zeros(len(self.domains[v]))
+                    indicator[list(self.domains[v]).index(value)] = 1.0
+                    f = f.product(Factor([v], self.domains, indicator))
+            for v, likelihood in self.likelihoods.items():
+                if self.home.get(v) == i:
+                    f = f.product(likelihood)
+            self.entered[i] = f
+        return self.entered[i]
+
+    def _scaled(self, f):
+        """Returns the factor normalized to sum to 1, separately for every
+        record when it has a record axis, and the log of the normalizer"""
+        if BATCH in f.variables:
+            axes = tuple([a for a, v in enumerate(f.variables) if v != BATCH])
+            total = f.values.sum(axis=axes, keepdims=True) if axes else \
+                f.values.copy()
+        else:
+            total = np.asarray(f.values.sum())
+        with np.errstate(divide='ignore'):
+            logTotal = np.log(total).ravel() if total.ndim else np.log(total)
+        total[total == 0] = 1.0
+        return Factor(f.variables, f.domains, f.values / total), logTotal
+
+    def _message(self, i, j):
+        """This method computes the message from clique i to clique j and
+        the log of the scale factors dropped from it and from the messages
+        it was computed from"""
+        f = self._potential(i)
+        scale = 0.0
+        for k in self.neighbours[i]:
+            if k != j:
+                f = f.product(self.messages[(k, i)])
+                scale = scale + self.scales[(k, i)]
+        shared = [v for v in self.cliques[i] if v in self.cliques[j]]
+        f, logTotal = self._scaled(f.marginalize(
+            [v for v in f.variables if v not in shared and v != BATCH]))
+        self.messages[(i, j)] = f
+        self.scales[(i, j)] = scale + logTotal
+
+    def _collect(self, target):
+        """This method computes every missing message on the way towards the
+        clique target. Messages already computed for the current evidence
+        are reused and the subtrees behind them are not visited."""
+        pending = []
+        stack = [(target, None)]
+        while stack:
+            i, parent = stack.pop()
+            for k in self.neighbours[i]:
+                if k != parent and (k, i) not in self.messages:
+                    pending.append((k, i))
+                    stack.append((k, i))
+        for k, i in reversed(pending):
+            self._message(k, i)
+
+    def setEvidence(self, e):
+        """This method enters the hard evidence in the dict e. Messages are
+        computed lazily when a belief is requested. Only the variables whose
+        evidence was added, retracted or changed since the last call are
+        propagated: the messages leading away from their home cliques are
+        dropped, while all messages towards them stay valid."""
+        if self.evidence is None:
+            self.evidence = dict(e)
+            return
+        changed = [v for v in set(self.evidence) | set(e)
+                   if self.evidence.get(v) != e.get(v)]
+        if not changed:
+            return
+        self.evidence = dict(e)
+        self.beliefs = {}
+        self.logNorms = {}
+        for v in changed:
+            if v in self.home:
+                self.entered.pop(self.home[v], None)
+                self._invalidate(self.home[v])
+
+    def _invalidate(self, source):
+        """This method drops every message directed away from the clique
+        source. A missing message means that the messages behind it are
+        missing as well, so the walk stops there."""
+        stack = [(source, None)]
+        while stack:
+            i, parent = stack.pop()
+            for k in self.neighbours[i]:
+                if k != parent and self.messages.pop((i, k), None) is not None:
+                    stack.append((k, i))
+
+    def setLikelihoods(self, likelihoods):
+        """This method enters soft evidence as a dict mapping variables to
+        factors over the variable, optionally with a record axis to give
+        every record its own likelihood, and clears all messages"""
+        self.likelihoods = dict(likelihoods)
+        self.entered = {}
+        self.messages = {}
+        self.scales = {}
+        self.beliefs = {}
+        self.logNorms = {}
+
+    def belief(self, i):
+        """This method returns the normalized belief of clique i, normalized
+        separately for every record when the evidence has a record axis"""
+        if i not in self.beliefs:
+            self._collect(i)
+            f = self._potential(i)
+            scale = 0.0
+            for k in self.neighbours[i]:
+                f = f.product(self.messages[(k, i)])
+                scale = scale + self.scales[(k, i)]
+            self.beliefs[i], logTotal = self._scaled(f)
+            self.logNorms[i] = scale + logTotal
+        return self.beliefs[i]
+
+    def logEvidence(self):
+        """This method returns the log probability of the evidence, an array
+        over the records when the evidence has a record axis"""
+        total = 0.0
+        for root in self.roots:
+            self.belief(root)
+            total = total + self.logNorms[root]
+        return total
+
+    def marginal(self, var):
+        """This method returns the posterior of a variable as a dict of
+        value:probability pairs"""
+        f = self.belief(self.home[var])
+        return f.marginalize(cut(f.variables, var)).normalize().toDist()
+
+
+
+class LoopyBeliefPropagation(object):
+    """Sum-product message passing on the factor graph of a list of factors,
+    which need not form a tree, with a 'synchronous' or a 'residual'
+    schedule and new messages mixed with the old by the damping weight."""
+    def __init__(self, factors):
+        self.factors = [f for f in factors if f.variables]
+        self.domains = {}
+        self.edges = {}
+        for a, f in enumerate(self.factors):
+            for v in f.variables:
+                self.domains[v] = f.domains[v]
+                self.edges.setdefault(v, []).append(a)
+        self.toVar = {}
+        self.toFactor = {}
+        for a, f in enumerate(self.factors):
+            for v in f.variables:
+                k = len(self.domains[v])
+                self.toVar[(a, v)] = np.ones(k) / k
+                self.toFactor[(v, a)] = np.ones(k) / k
+
+    def _factorMessage(self, a, x):
+        """Returns the normalized message from factor a to variable x given
+        the current variable to factor messages"""
+        f = self.factors[a]
+        values = f.values
+        for axis, v in enumerate(f.variables):
+            if v != x:
+                shape = [1] * len(f.variables)
+                shape[axis] = len(self.domains[v])
+                values = values * self.toFactor[(v, a)].reshape(shape)
+        axes = tuple([i for i, v in enumerate(f.variables) if v != x])
+        message = values.sum(axis=axes) if axes else values
+        total = message.sum()
+        return message / total if total else np.ones(len(message)) / len(message)
+
+    def _updateVariable(self, x):
+        """This method recomputes the messages from variable x to all its
+        factors, using prefix and suffix products so that each excludes the
+        message of its own factor"""
+        factors = self.edges[x]
+        incoming = [self.toVar[(a, x)] for a in factors]
+        prefix = [np.ones(len(self.domains[x]))]
+        for m in incoming[:-1]:
+            prefix.append(prefix[-1] * m)
+        suffix = np.ones(len(self.domains[x]))
+        for j in range(len(factors) - 1, -1, -1):
+            message = prefix[j] * suffix
+            total = message.sum()
+            self.toFactor[(x, factors[j])] = message / total if total else \
+                np.ones(len(message)) / len(message)
+            suffix = suffix * incoming[j]
+
+    def run(self, schedule='synchronous', damping=0.0, maxIter=100, tol=1e-6):
+        """This method passes messages until no message changes by more than
+        tol or maxIter sweeps over the edges are done, and returns the
+        number of sweeps, whether the messages converged and the last
+        largest change"""
+        if schedule == 'synchronous':
+            return self._runSynchronous(damping, maxIter, tol)
+        elif schedule == 'residual':
+            return self._runResidual(damping, maxIter, tol)
+        raise ValueError("Unknown message schedule " + str(schedule))
+
+    def _damped(self, key, message, damping):
+        if damping:
+            message = (1 - damping) * message + damping * self.toVar[key]
+        return message
+
+    def _runSynchronous(self, damping, maxIter, tol):
+        delta = 0.0
+        for iteration in range(1, maxIter + 1):
+            new = {}
+            for key in self.toVar:
+                new[key] = self._damped(key, self._factorMessage(*key),
+                                        damping)
+            delta = max([np.abs(new[key] - self.toVar[key]).max()
+                         for key in new] or [0.0])
+            self.toVar = new
+            for x in self.edges:
+                self._updateVariable(x)
+            if delta < tol:
+                return iteration, True, delta
+        return maxIter, False, delta
+
+    def _runResidual(self, damping, maxIter, tol):
+        candidate = {}
+        heap = []
+
+        def rescore(key):
+            message = self._damped(key, self._factorMessage(*key), damping)
+            candidate[key] = message
+            residual = np.abs(message - self.toVar[key]).max()
+            heapq.heappush(heap, (-residual, key))
+        for x in self.edges:
+            self._updateVariable(x)
+        for key in self.toVar:
+            rescore(key)
+        updates = 0
+        budget = maxIter * max(len(self.toVar), 1)
+        delta = 0.0
+        while heap and updates < budget:
+            residual, key = heapq.heappop(heap)
+            residual = -residual
+            if key not in candidate:
+                continue
+            current = np.abs(candidate[key] - self.toVar[key]).max()
+            if current != residual:
+                continue
+            delta = residual
+            if residual < tol:
+                return updates // max(len(self.toVar), 1) + 1, True, delta
+            a, x = key
+            self.toVar[key] = candidate.pop(key)
+            updates += 1
+            self._updateVariable(x)
+            if damping:
+                rescore(key)
+            for b in self.edges[x]:
+                if b != a:
+                    for y in self.factors[b].variables:
+                        if y != x:
+                            rescore((b, y))
+        converged = not heap or delta < tol
+        return updates // max(len(self.toVar), 1), converged, delta
+
+    def marginal(self, x):
+        """This method returns the belief of variable x as a dict of
+        value:probability pairs"""
+        belief = np.ones(len(self.domains[x]))
+        for a in self.edges[x]:
+            belief = belief * self.toVar[(a, x)]
+        total = belief.sum()
+        if total:
+            belief = belief / total
+        return dict(zip(self.domains[x], belief.tolist()))
+
+
+
+class EnumerationPlan(object):
+    """The variables of an enumeration over a CompiledNetwork in topological
+    order. For position i it holds the network code, the CPT rows and the
+    enumerated and observed parents with their strides, and for the memo
+    the earlier parents and the evidence the rest of the sum depends on."""
+    def __init__(self, compiled, vars, observed):
+        codes = set(vars)
+        stack = list(vars)
+        while stack:
+            for p in compiled.parents[stack.pop()]:
+                if p not in codes and p not in observed:
+                    codes.add(p)
+                    stack.append(p)
+        order = sorted(codes)
+        position = dict([(c, i) for i, c in enumerate(order)])
+        self.key = tuple(order)
+        self.codes = order
+        self.tables = []
+        self.internal = []
+        self.external = []
+        self.frontier = []
+        self.relevant = []
+        for c in order:
+            self.tables.append(compiled.probs[c].tolist())
+            internal = []
+            external = []
+            for p, stride in zip(compiled.parents[c], compiled.strides[c]):
+                if p in position:
+                    internal.append((position[p], stride))
+                else:
+                    external.append((p, stride))
+            self.internal.append(internal)
+            self.external.append(external)
+        for i in range(len(order)):
+            frontier = set()
+            relevant = set()
+            for c in order[i:]:
+                if c in observed:
+                    relevant.add(c)
+                for p in compiled.parents[c]:
+                    if p in position and position[p] < i:
+                        frontier.add(position[p])
+                    elif p in observed:
+                        relevant.add(p)
+            self.frontier.append(sorted(frontier))
+            self.relevant.append(sorted(relevant))
+
+
+
+class CompiledNode(object):
+    """A node of a CompiledNetwork. code is the position of the node in the
+    topological order of the network, levelCode maps its values to their
+    integer codes, parents holds the codes of its parents and strides their
+    weights in the mixed-radix row index of table, the read-only array of
+    its CPT rows."""
+    __slots__ = ('name', 'code', 'levels', 'levelCode', 'parents', 'strides',
+                 'table')
+
+    def __init__(self, name, code, levels, parents, strides, table):
+        self.name = name
+        self.code = code
+        self.levels = levels
+        self.levelCode = dict([(v, i) for i, v in enumerate(levels)])
+        self.parents = parents
+        self.strides = strides
+        self.table = table
+
+
+class CompiledNetwork(object):
+    """A frozen copy of a DiscreteBayesNet on which the inference engines
+    run, with variables and values referred to by integer codes in
+    topological order and every CPT held as a read-only array. Plans
+    derived from the snapshot are cached in it for good."""
+    __slots__ = ('key', 'names', 'position', 'nodes', 'levels', 'parents',
+                 'children', 'strides', 'probs', 'cdf', 'domains', 'factors',
+                 'ordering', 'prune', 'plans')
+
+    def __init__(self, bn, key=None):
+        self.key = key
+        self.names = tuple(bn.topologicalOrder())
+        self.position = dict([(name, i) for i, name in enumerate(self.names)])
+        self.ordering = bn.ordering
+        self.prune = bn.prune
+        nodes = []
+        children = [[] for name in self.names]
+        self.domains = {}
+        factors = []
+        cdfs = []
+        for i, name in enumerate(self.names):
+            node = bn.variables[name]
+            levels = tuple(node.cpt.values())
+            parents = tuple([self.position[p] for p in node.parents])
+            parentLevels = [bn.variables[p].cpt.values() for p in node.parents]
+            table = np.array(node.cpt.toFactor(name, node.parents, parentLevels)
+                             .values.reshape(-1, len(levels)))
+            table.flags.writeable = False
+            strides = []
+            stride = 1
+            for p in reversed(parents):
+                strides.insert(0, stride)
+                stride *= len(nodes[p].levels)
+            for p in parents:
+                children[p].append(i)
+            self.domains[i] = range(len(levels))
+            factors.append(Factor(list(parents) + [i], self.domains,
+                                  table.reshape([len(nodes[p].levels)
+                                                 for p in parents] +
+                                                [len(levels)])))
+            # Row cumulative sums offset by the row number form one
+            # increasing array, so a batch is drawn with one searchsorted
+            cdf = np.cumsum(table, axis=1)
+            total = cdf[:, -1:].copy()
+            cdf[(total == 0)[:, 0], -1] = 1.0
+            total[total == 0] = 1.0
+            cdf = (cdf / total + np.arange(len(cdf))[:, None]).ravel()
+            cdf.flags.writeable = False
+            cdfs.append(cdf)
+            nodes.append(CompiledNode(name, i, levels, parents, tuple(strides),
+                                      table))
+        self.nodes = tuple(nodes)
+        self.levels = tuple([node.levels for node in nodes])
+        self.parents = tuple([node.parents for node in nodes])
+        self.strides = tuple([node.strides for node in nodes])
+        self.probs = tuple([node.table for node in nodes])
+        self.children = tuple([tuple(c) for c in children])
+        self.cdf = tuple(cdfs)
+        self.factors = tuple(factors)
+        self.plans = {}
+
+    def encode(self, e):
+        """Returns the evidence dict e, which maps variable names to values,
+        as a dict mapping variable codes to value codes. Variables that are
+        not in the network are left out."""
+        codes = {}
+        for v, value in e.items():
+            i = self.position.get(v)
+            if i is not None:
+                try:
+                    codes[i] = self.nodes[i].levelCode[value]
+                except KeyError:
+                    raise ValueError(str(value) + " is not a value of " + v)
+        return codes
+
+    def decode(self, i, probs):
+        """Returns a sequence of probabilities of the values of variable i,
+        or a dict keyed by their codes, as a value:probability dict"""
+        if isinstance(probs, dict):
+            probs = [probs[c] for c in range(len(self.levels[i]))]
+        return dict(zip(self.levels[i], list(probs)))
+
+    def rowIndex(self, codes, i):
+        """Returns for every sample in the 2-D code array the CPT row of
+        variable i"""
+        index = np.zeros(len(codes), dtype=int)
+        for p, stride in zip(self.parents[i], self.strides[i]):
+            index += codes[:, p] * stride
+        return index
+
+    def draw(self, codes, i, rng):
+        """This method samples variable i for every row of the code array,
+        given the codes of its parents"""
+        index = self.rowIndex(codes, i)
+        k = len(self.levels[i])
+        drawn = np.searchsorted(self.cdf[i], index + rng.random_sample(len(codes)),
+                                side='right') - index * k
+        codes[:, i] = np.minimum(drawn, k - 1)
+
+    def _plans(self, kind):
+        return self.plans.setdefault(kind, {})
+
+    def relevant(self, q, observed, blocking=True):
+        """Returns the codes of the variables whose CPTs are needed for the
+        posterior of variable q given evidence on the variables in observed,
+        dropping barren variables and, when blocking is True, those
+        d-separated from q by the evidence. All are returned when pruning is off."""
+        if not self.prune:
+            return range(len(self.names))
+        cache = self._plans('relevance')
+        key = (q, frozenset(observed), blocking)
+        if key in cache:
+            return cache[key]
+        ancestral = set([q])
+        ancestral.update(observed)
+        stack = list(ancestral)
+        while stack:
+            for p in self.parents[stack.pop()]:
+                if p not in ancestral:
+                    ancestral.add(p)
+                    stack.append(p)
+        if blocking:
+            moral = dict([(i, set()) for i in ancestral])
+            for i in ancestral:
+                family = (i,) + self.parents[i]
+                for a in family:
+                    moral[a].update(family)
+            component = set([q])
+            stack = [q]
+            while stack:
+                for i in moral[stack.pop()]:
+                    if i not in component and i not in observed:
+                        component.add(i)
+                        stack.append(i)
+        else:
+            component = ancestral
+        relevant = [i for i in sorted(ancestral)
+                    if i in component or
+                    [p for p in self.parents[i] if p in component]]
+        cache[key] = relevant
+        return relevant
+
+    def mapRelevant(self, vars, observed):
+        """Returns the codes of the variables that are ancestors of a
+        variable in vars or of an observed variable; the others are barren
+        and sum to one"""
+        relevant = set()
+        for q in vars:
+            relevant.update(self.relevant(q, observed, False))
+        return sorted(relevant)
+
+    def eliminationOrder(self, q, observed, factors, hidden, batch=False):
+        """Returns the elimination order for a query on variable q with the
+        variables in observed observed, cached per query variable and set
+        of observed variables. Batch queries keep the observed variables in
+        the factors and get orders of their own."""
+        cache = self._plans('elimination')
+        key = (q, frozenset(observed), batch)
+        if key not in cache:
+            cache[key] = elimination_order(factors, hidden, self.ordering)
+        return cache[key]
+
+    def mapOrders(self, vars, observed, factors, batch):
+        """Returns the orders in which the other variables are summed out and
+        the variables in vars are then maximized out, cached like the
+        elimination orders"""
+        cache = self._plans('map')
+        key = (frozenset(vars), frozenset(observed), batch)
+        if key not in cache:
+            scopes = [set(f.variables) for f in factors]
+            domains = {}
+            for f in factors:
+                for v in f.variables:
+                    domains[v] = f.domains[v]
+            hidden = sorted(set(domains) - set(vars) - set([BATCH]))
+            sumOrder = elimination_order(factors, hidden, self.ordering)
+            for Y in sumOrder:
+                related = [sc for sc in scopes if Y in sc]
+                if related:
+                    scopes = [sc for sc in scopes if Y not in sc]
+                    scopes.append(set.union(*related) - set([Y]))
+            remaining = [Factor(sorted(sc), domains, 0.0) for sc in scopes]
+            maxOrder = elimination_order(remaining,
+                                         [v for v in vars if v in domains],
+                                         self.ordering)
+            cache[key] = (sumOrder, maxOrder)
+        return cache[key]
+
+    def enumerationPlan(self, vars, observed):
+        """Returns the enumeration plan for the variables in vars with the
+        variables in observed observed, built once per set of variables and
+        set of observed variables"""
+        cache = self._plans('enumeration')
+        key = (frozenset(vars), frozenset(observed))
+        if key not in cache:
+            cache[key] = EnumerationPlan(self, vars, observed)
+        return cache[key]
+
+    def junctionTree(self):
+        """Returns the junction tree of the network, compiled on first use"""
+        if 'junctiontree' not in self.plans:
+            order = elimination_order(self.factors, range(len(self.names)),
+                                      self.ordering)
+            self.plans['junctiontree'] = JunctionTree(self.factors, order)
+        return self.plans['junctiontree']
+
+    def circuit(self):
+        """Returns the arithmetic circuit of the network, compiled on first
+        use"""
+        if 'circuit' not in self.plans:
+            self.plans['circuit'] = ArithmeticCircuit.compile(self)
+        return self.plans['circuit']
+
+
+
+class ArithmeticCircuit(object):
+    """An arithmetic circuit computing the network polynomial of a compiled
+    network, stored as flat arrays of node operations, children, parameter
+    values and levels and evaluated one level at a time. Values are not
+    rescaled, so evidence probabilities must not underflow."""
+    PARAMETER, INDICATOR, ADD, MUL = 0, 1, 2, 3
+
+    def __init__(self, op, left, right, value, level, root, indicators,
+                 names, levels):
+        self.op = op
+        self.left = left
+        self.right = right
+        self.value = value
+        self.level = level
+        self.root = int(root)
+        self.indicators = [np.asarray(i) for i in indicators]
+        self.names = list(names)
+        self.levels = [list(l) for l in levels]
+        self.position = dict([(name, i) for i, name in enumerate(self.names)])
+        self.levelCode = [dict([(v, j) for j, v in enumerate(l)])
+                          for l in self.levels]
+        self.parameters = np.nonzero(op == self.PARAMETER)[0]
+        inner = np.nonzero(op >= self.ADD)[0]
+        inner = inner[np.argsort(level[inner], kind='mergesort')]
+        bounds = np.nonzero(np.diff(level[inner]))[0] + 1
+        self.schedule = []
+        for ids in np.split(inner, bounds):
+            if len(ids):
+                adds = ids[op[ids] == self.ADD]
+                muls = ids[op[ids] == self.MUL]
+                children = np.concatenate([left[adds], right[adds],
+                                           left[muls], right[muls]])
+                order = np.argsort(children, kind='mergesort')
+                targets, starts = np.unique(children[order], return_index=True)
+                self.schedule.append((adds, muls, targets, order, starts))
+
+    @classmethod
+    def compile(cls, compiled):
+        """Returns the circuit of a CompiledNetwork, built by eliminating
+        the variables symbolically in the order chosen by the ordering
+        heuristic of the network: every product and sum of the
+        elimination becomes a layer of MUL and ADD nodes"""
+        builder = _CircuitBuilder()
+        sizes = [len(l) for l in compiled.levels]
+        indicators = []
+        factors = []
+        for i, f in enumerate(compiled.factors):
+            params = builder.leaves(cls.PARAMETER, f.values.ravel())
+            indicator = builder.leaves(cls.INDICATOR, np.zeros(sizes[i]))
+            indicators.append(indicator)
+            factors.append(builder.product(
+                (f.variables, params.reshape(f.values.shape)),
+                ([i], indicator), sizes))
+        order = elimination_order(compiled.factors, range(len(sizes)),
+                                  compiled.ordering)
+        for Y in order:
+            related = [f for f in factors if Y in f[0]]
+            if not related:
+                continue
+            factors = [f for f in factors if Y not in f[0]]
+            joint = related[0]
+            for f in related[1:]:
+                joint = builder.product(joint, f, sizes)
+            factors.append(builder.sumOut(joint, Y))
+        if factors:
+            root = factors[0]
+            for f in factors[1:]:
+                root = builder.product(root, f, sizes)
+            root = int(root[1])
+        else:
+            root = int(builder.leaves(cls.PARAMETER, np.ones(1))[0])
+        op, left, right, value, level = builder.arrays()
+        return cls(op, left, right, value, level, root, indicators,
+                   compiled.names, compiled.levels)
+
+    def encode(self, e):
+        """Returns the evidence dict e, which maps variable names to values,
+        as a 2-D code array with a single row and -1 for the variables
+        without evidence"""
+        codes = -np.ones((1, len(self.names)), dtype=int)
+        for v, value in e.items():
+            i = self.position.get(v)
+            if i is not None:
+                try:
+                    codes[0, i] = self.levelCode[i][value]
+                except KeyError:
+                    raise ValueError(str(value) + " is not a value of " + v)
+        return codes
+
+    def _upward(self, codes):
+        """Returns the values of all nodes, one column per row of the code
+        array"""
+        values = np.empty((len(self.op), len(codes)))
+        values[self.parameters] = self.value[self.parameters][:, None]
+        for i, ids in enumerate(self.indicators):
+            values[ids] = evidence_indicators(codes[:, i], len(ids)).T
+        for adds, muls, targets, order, starts in self.schedule:
+            if len(adds):
+                values[adds] = values[self.left[adds]] + values[self.right[adds]]
+            if len(muls):
+                values[muls] = values[self.left[muls]] * values[self.right[muls]]
+        return values
+
+    def evaluate(self, evidence):
+        """This method returns the probability of the evidence, given as a
+        dict of variable:value mappings, or as an array for a 2-D code
+        array of evidence records with one column per variable in the order
+        of names and -1 for unobserved entries"""
+        if isinstance(evidence, dict):
+            return float(self._upward(self.encode(evidence))[self.root, 0])
+        return self._upward(np.asarray(evidence))[self.root]
+
+    def posteriors(self, evidence):
+        """This method returns the probability of the evidence, given as for
+        evaluate, and the posterior marginals of all variables from one
+        upward and one downward pass, as a dict of value:probability dicts
+        for a dict and as one array of rows per variable for a code array"""
+        single = isinstance(evidence, dict)
+        codes = self.encode(evidence) if single else np.asarray(evidence)
+        values = self._upward(codes)
+        grads = np.zeros_like(values)
+        grads[self.root] = 1.0
+        for adds, muls, targets, order, starts in reversed(self.schedule):
+            terms = np.concatenate([grads[adds], grads[adds],
+                                    grads[muls] * values[self.right[muls]],
+                                    grads[muls] * values[self.left[muls]]])
+            grads[targets] += np.add.reduceat(terms[order], starts, axis=0)
+        marginals = []
+        for ids in self.indicators:
+            joint = grads[ids].T
+            total = joint.sum(axis=1, keepdims=True)
+            total[total == 0] = 1.0
+            marginals.append(joint / total)
+        p = values[self.root]
+        if single:
+            return float(p[0]), dict([(name, dict(zip(self.levels[i],
+                                                      marginals[i][0].tolist())))
+                                      for i, name in enumerate(self.names)])
+        return p, marginals
+
+    def save(self, filename):
+        """This method writes the circuit to a NumPy .npz file, from which
+        load_circuit restores it without the network. The file is written
+        under filename as given, without an .npz suffix being added."""
+        with open(filename, 'wb') as f:
+            np.savez(f, op=self.op, left=self.left, right=self.right,
+                     value=self.value, level=self.level, root=self.root,
+                     indicators=np.concatenate(self.indicators or
+                                               [np.zeros(0)]),
+                     sizes=np.array([len(i) for i in self.indicators],
+                                    dtype=int),
+                     meta=json.dumps({'names': self.names,
+                                      'levels': self.levels}))
+
+
+def load_circuit(filename):
+    """Returns the ArithmeticCircuit saved to an .npz file by its save
+    method"""
+    data = np.load(filename)
+    meta = json.loads(str(data['meta']))
+    starts = np.concatenate([[0], np.cumsum(data['sizes'])])
+    indicators = [data['indicators'][starts[i]:starts[i+1]].astype(int)
+                  for i in range(len(data['sizes']))]
+    return ArithmeticCircuit(data['op'], data['left'], data['right'],
+                             data['value'], data['level'], data['root'],
+                             indicators, meta['names'], meta['levels'])
+
+
+class _CircuitBuilder(object):
+    """Collects the nodes of an arithmetic circuit while the variables of
+    a network are eliminated symbolically. Symbolic factors are (variables,
+    array of node ids) pairs, and every operation on them appends one
+    vector of nodes whose children already exist to buffers that double
+    in size when full."""
+    def __init__(self):
+        self.size = 0
+        self.op = np.zeros(1024, dtype=np.int8)
+        self.left = np.zeros(1024, dtype=int)
+        self.right = np.zeros(1024, dtype=int)
+        self.value = np.zeros(1024)
+        self.level = np.zeros(1024, dtype=int)
+
+    def _append(self, count, op, left, right, value, level):
+        start = self.size
+        self.size += count
+        if self.size > len(self.op):
+            capacity = max(self.size, 2 * len(self.op))
+            for name in ('op', 'left', 'right', 'value', 'level'):
+                old = getattr(self, name)
+                new = np.zeros(capacity, dtype=old.dtype)
+                new[:start] = old[:start]
+                setattr(self, name, new)
+        self.op[start:self.size] = op
+        self.left[start:self.size] = left
+        self.right[start:self.size] = right
+        self.value[start:self.size] = value
+        self.level[start:self.size] = level
+        return np.arange(start, self.size)
+
+    def leaves(self, op, values):
+        return self._append(len(values), op, 0, 0, values, 0)
+
+    def _inner(self, op, left, right):
+        level = np.maximum(self.level[left], self.level[right]) + 1
+        return self._append(len(left), op, left, right, 0.0, level)
+
+    def product(self, a, b, sizes):
+        variables = list(a[0]) + [v for v in b[0] if v not in a[0]]
+        shape = [sizes[v] for v in variables]
+        left = np.broadcast_to(self._aligned(a, variables), shape).ravel()
+        right = np.broadcast_to(self._aligned(b, variables), shape).ravel()
+        return variables, self._inner(ArithmeticCircuit.MUL, left,
+                                      right).reshape(shape)
+
+    def _aligned(self, f, variables):
+        """Returns the ids of a symbolic factor arranged like
+        Factor._aligned"""
+        variables_f, ids = f
+        variables_f = list(variables_f)
+        order = sorted(range(len(variables_f)),
+                       key=lambda i: variables.index(variables_f[i]))
+        shape = [ids.shape[variables_f.index(v)] if v in variables_f else 1
+                 for v in variables]
+        return ids.transpose(order).reshape(shape)
+
+    def sumOut(self, f, var):
+        variables, ids = f
+        ids = np.moveaxis(ids, list(variables).index(var), 0)
+        total = ids[0]
+        for t in range(1, len(ids)):
+            total = self._inner(ArithmeticCircuit.ADD, total.ravel(),
+                                ids[t].ravel()).reshape(total.shape)
+        return [v for v in variables if v != var], total
+
+    def arrays(self):
+        """Returns the op, left, right, value and level arrays of the
+        circuit"""
+        return (self.op[:self.size].copy(), self.left[:self.size].copy(),
+                self.right[:self.size].copy(), self.value[:self.size].copy(),
+                self.level[:self.size].copy())
+
+
+_workerState = None
+
+
+def _init_worker(state):
+    """Pool initializer that hands the large read-only state of a parallel
+    job to every worker once. The worker functions below are module level
+    so that a multiprocessing pool can send them by name."""
+    global _workerState
+    _workerState = state
+
+
+def gibbs_chains(job):
+    """Runs a block of Gibbs chains side by side and returns the counts of
+    the values of the query variable per chain, together with the number
+    of retained sweeps each chain spent in states the evidence rules out,
+    which are not counted. job is (Markov blanket tables, initial states,
+    sweeps, burn-in sweeps, query position, number of values, seed)."""
+    tables, state, sweeps, burnIn, q, k, seed = job
+    rng = np.random.RandomState(seed)
+    state = state.copy()
+    chains = len(state)
+    rows = np.arange(chains)
+    counts = np.zeros((chains, k))
+    zeroMass = np.zeros(chains, dtype=int)
+    for t in range(burnIn + sweeps):
+        dead = np.zeros(chains, dtype=bool)
+        for i, blanket, strides, cdf in tables:
+            if blanket:
+                c = cdf[state[:, blanket].dot(strides)]
+            else:
+                c = np.repeat(cdf, chains, axis=0)
+            u = rng.random_sample(chains)[:, None] * c[:, -1:]
+            zero = c[:, -1] == 0
+            dead |= zero
+            state[:, i] = np.where(zero, state[:, i],
+                                   np.minimum((u >= c).sum(axis=1),
+                                              c.shape[1] - 1))
+        if t >= burnIn:
+            live = ~dead
+            counts[rows[live], state[live, q]] += 1
+            zeroMass += dead
+    return counts, zeroMass
+
+
+def potential_scale_reduction(counts):
+    """Returns the Gelman-Rubin R-hat statistic of the indicator of every
+    value, computed from per-chain value counts with one row per chain, as
+    the largest value over all values"""
+    counts = np.asarray(counts, dtype=float)
+    m = len(counts)
+    n = counts[0].sum()
+    if m < 2 or n < 2:
+        return float('nan')
+    means = counts / n
+    within = (means * (1 - means) * n / (n - 1)).mean(axis=0)
+    between = n * means.var(axis=0, ddof=1)
+    pooled = (n - 1) / n * within + between / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rhat = np.sqrt(np.where(within > 0, pooled / within, 1.0))
+    return float(rhat.max())
+
+
+
+
+def enumeration_sum(job):
+    """Returns the probability of the evidence of a (variables, evidence)
+    job of the parallel enumeration in query_ask, on the network handed to
+    the pool initializer"""
+    return _workerState._enumerationJob(job)
+
+
+
+def em_expectations(job):
+    """Returns the expected counts of every family and the log-likelihood
+    of one shard of data. job is (junction tree, families, shard, batchSize),
+    where the shard is a dict of code arrays or its index in the shards
+    handed to the pool initializer."""
+    jt, families, shard, batchSize = job
+    if isinstance(shard, int):
+        shard = _workerState[shard]
+    n = len(shard.values()[0]) if shard else 0
+    counts = [np.zeros([len(jt.domains[v]) for v in family])
+              for family in families]
+    logLikelihood = 0.0
+    for start in range(0, n, batchSize):
+        size = min(batchSize, n - start)
+        domains = dict(jt.domains)
+        domains[BATCH] = range(size)
+        likelihoods = {}
+        for v, c in shard.items():
+            c = c[start:start+size]
+            if v in jt.home and (c >= 0).any():
+                likelihoods[v] = Factor([BATCH, v], domains,
+                                        evidence_indicators(c, len(domains[v])))
+        jt.setLikelihoods(likelihoods)
+        for i, family in enumerate(families):
+            belief = jt.belief(jt.assigned[i])
+            f = belief.marginalize([v for v in belief.variables
+                                    if v not in family and v != BATCH])
+            if BATCH in f.variables:
+                counts[i] += f._aligned(family + [BATCH]).sum(axis=-1)
+            else:
+                counts[i] += f._aligned(family) * size
+        logLikelihood += np.broadcast_to(jt.logEvidence(), (size,)).sum()
+    return counts, logLikelihood
+
+
+
+class CountIndex(object):
+    """A reusable index of the contingency counts of code arrays, with -1 for
+    missing entries, over the distinct records and their multiplicities.
+    Count tables are kept in an LRU cache of maxsize entries, and a table
+    is summed from a cached one over a never missing extra variable."""
+    def __init__(self, codes, levels, maxsize=4096):
+        self.variables = sorted(codes)
+        self.levels = dict([(v, list(levels[v])) for v in self.variables])
+        table = np.column_stack([codes[v] for v in self.variables]) \
+            if self.variables else np.zeros((0, 0), dtype=int)
+        rows, self.weights = np.unique(table, axis=0, return_counts=True)
+        self.rows = np.asfortranarray(rows)
+        self.complete = set([v for i, v in enumerate(self.variables)
+                             if not (self.rows[:, i] < 0).any()])
+        self.column = dict([(v, i) for i, v in enumerate(self.variables)])
+        self.records = int(self.weights.sum())
+        self.cache = LRUCache(maxsize)
+
+    def counts(self, vars):
+        """This method returns the number of records holding every joint
+        value of the variables in vars, as an array with one axis per
+        variable in the order given. Records missing a value of one of the
+        variables are not counted. The array is shared with the cache and
+        must not be modified."""
+        key = tuple(sorted(vars))
+        table = self.cache.get(key)
+        if table is None:
+            table = self._derive(key)
+            if table is None:
+                sizes = [len(self.levels[v]) for v in key]
+                index, valid = family_index(
+                    [self.rows[:, self.column[v]] for v in key] or
+                    [np.zeros(len(self.rows), dtype=int)], sizes or [1])
+                table = np.bincount(index[valid], self.weights[valid],
+                                    int(np.prod(sizes))).reshape(sizes)
+            self.cache.put(key, table)
+        return table.transpose([key.index(v) for v in vars])
+
+    def _derive(self, key):
+        """Returns the counts of the sorted variables in key summed from the
+        smallest cached table over them and one more variable that is never
+        missing, or None"""
+        best = None
+        for v in self.complete.difference(key):
+            other = tuple(sorted(key + (v,)))
+            table = self.cache.entries.get(other)
+            if table is not None and (best is None or table.size < best[1]):
+                best = (other.index(v), table.size, table)
+        if best is None:
+            return None
+        return best[2].sum(axis=best[0])
+
+
+
+class CPTLearner(object):
+    """Maximum likelihood estimation of the CPTs of a network structure, given
+    as a dict of parent lists, from data counted in chunks with np.bincount.
+    Values missing from levels are collected from the data, and rows with
+    a missing value in a family are not counted for that family."""
+    def __init__(self, structure, levels=None):
+        self.parents = dict([(v, list(p)) for v, p in structure.items()])
+        self.levels = dict([(v, []) for v in self.parents])
+        self.fixed = set()
+        for v, l in (levels or {}).items():
+            if l:
+                self.levels[v] = list(l)
+                self.fixed.add(v)
+        self.counts = {}
+        self.rows = 0
+
+    def family(self, var):
+        return self.parents[var] + [var]
+
+    def _shape(self, var):
+        return [len(self.levels[v]) for v in self.family(var)]
+
+    def _grow(self, var):
+        """This method pads the counts of a family to the current numbers of
+        values of its variables"""
+        shape = self._shape(var)
+        old = self.counts.get(var)
+        if old is None or list(old.shape) != shape:
+            counts = np.zeros(shape)
+            if old is not None:
+                counts[tuple([slice(0, n) for n in old.shape])] = old
+            self.counts[var] = counts
+
+    def encode(self, chunk):
+        """Returns a dict mapping the variables to the integer codes of their
+        columns in chunk, which may be any mapping from names to columns"""
+        return dict([(v, encode_levels(chunk[v], self.levels[v],
+                                       v not in self.fixed))
+                     for v in self.parents])
+
+    def update(self, chunk):
+        """This method adds the counts of a chunk of data"""
+        codes = self.encode(chunk)
+        for var in self.parents:
+            self._grow(var)
+            counts = self.counts[var]
+            family = self.family(var)
+            index, valid = family_index([codes[v] for v in family],
+                                        counts.shape)
+            counts += np.bincount(index[valid], minlength=counts.size
+                                  ).reshape(counts.shape)
+        self.rows += len(codes.values()[0]) if codes else 0
+
+    def addCounts(self, index):
+        """This method adds the family counts answered by a CountIndex over
+        the same variables. Variables without known values take those of
+        the index."""
+        for var in self.parents:
+            for v in self.family(var):
+                if v not in self.fixed and not self.levels[v]:
+                    self.levels[v] = list(index.levels[v])
+                    self.fixed.add(v)
+                elif list(self.levels[v]) != index.levels[v]:
+                    raise ValueError("The values of " + v +
+                                     " differ from those of the index")
+        for var in self.parents:
+            self._grow(var)
+            self.counts[var] += index.counts(self.family(var))
+        self.rows += index.records
+
+    def cpts(self, alpha=0.0, compact=False):
+        """Returns a dict mapping every variable to its estimated
+        DiscreteCPT, smoothed with a symmetric Dirichlet prior that adds
+        alpha to every count. Parent configurations never seen get a uniform
+        distribution. With compact set, the tables are CompactCPTs built
+        straight from the count arrays."""
+        result = {}
+        for var in self.parents:
+            self._grow(var)
+            counts = self.counts[var] + alpha
+            k = counts.shape[-1]
+            rows = counts.reshape(-1, k)
+            total = rows.sum(axis=1, keepdims=True)
+            probs = np.where(total > 0, rows / np.where(total > 0, total, 1),
+                             1.0 / k) if k else rows
+            if compact:
+                result[var] = CompactCPT(list(self.levels[var]),
+                                         [self.levels[p]
+                                          for p in self.parents[var]], probs)
+                continue
+            configurations = itertools.product(*[self.levels[p]
+                                                 for p in self.parents[var]])
+            table = dict(zip([tuple(c) for c in configurations],
+                             probs.tolist()))
+            if not self.parents[var]:
+                table = table[()]
+            result[var] = DiscreteCPT(list(self.levels[var]), table)
+        return result
+
+
+
+_lgamma = np.vectorize(math.lgamma, otypes=[float])
+
+
+def family_score(family):
+    """Returns the local score of a (variable, parents) pair under the
+    search handed to the pool initializer"""
+    return _workerState.computeScore(*family)
+
+
+class StructureSearch(object):
+    """Score-based search for the structure of a Bayesian network from the
+    code arrays and levels of discrete data, with the 'bic' or 'bdeu'
+    score. Local scores are cached per variable and parent set, so a move
+    only rescores the families it changes."""
+    def __init__(self, codes, levels, score='bic', ess=1.0, maxParents=3):
+        if score not in ('bic', 'bdeu'):
+            raise ValueError("Unknown score " + str(score))
+        self.index = CountIndex(codes, levels)
+        self.levels = levels
+        self.variables = sorted(codes)
+        self.score = score
+        self.ess = ess
+        self.maxParents = maxParents
+        self.cache = {}
+
+    def computeScore(self, var, parents):
+        """This method returns the local score of var given the parents,
+        without looking at the cache"""
+        counts = self.index.counts(list(parents) + [var]
+                                   ).reshape(-1, len(self.levels[var]))
+        totals = counts.sum(axis=1)
+        q, r = counts.shape
+        if self.score == 'bic':
+            nonzero = counts > 0
+            logLikelihood = (counts[nonzero] * np.log(
+                (counts / np.where(totals > 0, totals, 1)[:, None])[nonzero])
+                             ).sum()
+            return float(logLikelihood -
+                         0.5 * np.log(max(totals.sum(), 1)) * q * (r - 1))
+        a = float(self.ess)
+        return float((_lgamma(a / q) - _lgamma(a / q + totals)).sum() +
+                     (_lgamma(a / (q * r) + counts) -
+                      _lgamma(a / (q * r))).sum())
+
+    def localScore(self, var, parents):
+        """This method returns the cached local score of var given the
+        parents"""
+        key = (var, frozenset(parents))
+        if key not in self.cache:
+            self.cache[key] = self.computeScore(var, sorted(parents))
+        return self.cache[key]
+
+    def totalScore(self, parents):
+        """This method returns the score of the structure given as a dict
+        mapping every variable to its list of parents"""
+        return sum([self.localScore(v, parents[v]) for v in self.variables])
+
+    def _reaches(self, children, source, target, skip=None):
+        """Returns whether a directed path leads from source to target,
+        ignoring the edge from source to skip"""
+        stack = [source]
+        seen = set(stack)
+        while stack:
+            i = stack.pop()
+            for c in children[i]:
+                if i == source and c == skip:
+                    continue
+                if c == target:
+                    return True
+                if c not in seen:
+                    seen.add(c)
+                    stack.append(c)
+        return False
+
+    def moves(self, parents):
+        """Returns every legal move from the structure as a list of
+        (operation, parent, child, changed families) tuples, where the
+        operation is 'add', 'delete' or 'reverse' and the changed families
+        are (variable, new parents) pairs"""
+        result = []
+        children = dict([(v, []) for v in self.variables])
+        for v in self.variables:
+            for p in parents[v]:
+                children[p].append(v)
+        for v in self.variables:
+            for u in self.variables:
+                if u == v:
+                    continue
+                if u in parents[v]:
+                    rest = [p for p in parents[v] if p != u]
+                    result.append(('delete', u, v, [(v, rest)]))
+                    if len(parents[u]) < self.maxParents and \
+                            not self._reaches(children, u, v, v):
+                        result.append(('reverse', u, v,
+                                       [(v, rest), (u, parents[u] + [v])]))
+                elif v not in parents[u] and \
+                        len(parents[v]) < self.maxParents and \
+                        not self._reaches(children, v, u):
+                    result.append(('add', u, v, [(v, parents[v] + [u])]))
+        return result
+
+    def search(self, method='hill-climbing', start=None, maxIter=1000,
+               tabuLength=10, patience=10, workers=1):
+        """This method searches by 'hill-climbing' or 'tabu' moves from
+        start, or the empty graph, and returns the best structure found as
+        a dict of parent lists together with its score. New local scores
+        are computed in a pool of workers processes."""
+        if method not in ('hill-climbing', 'tabu'):
+            raise ValueError("Unknown search method " + str(method))
+        parents = dict([(v, list((start or {}).get(v, [])))
+                        for v in self.variables])
+        score = self.totalScore(parents)
+        best = (dict([(v, list(p)) for v, p in parents.items()]), score)
+        tabu = collections.deque(maxlen=tabuLength)
+        undo = {'add': 'delete', 'delete': 'add', 'reverse': 'reverse'}
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, _init_worker, (self,))
+        try:
+            stale = 0
+            for step in range(maxIter):
+                moves = self.moves(parents)
+                missing = set()
+                for move in moves:
+                    for v, p in move[3]:
+                        if (v, frozenset(p)) not in self.cache:
+                            missing.add((v, tuple(sorted(p))))
+                missing = list(missing)
+                if pool is not None and len(missing) > 1:
+                    scores = pool.map(family_score, missing)
+                else:
+                    scores = [self.computeScore(*f) for f in missing]
+                for (v, p), s in zip(missing, scores):
+                    self.cache[(v, frozenset(p))] = s
+                if not moves:
+                    break
+                deltas = [sum([self.localScore(v, p) -
+                               self.localScore(v, parents[v])
+                               for v, p in move[3]]) for move in moves]
+                if method == 'tabu':
+                    deltas = [-np.inf if (m[0], m[1], m[2]) in tabu and
+                              score + d <= best[1] + 1e-9 else d
+                              for m, d in zip(moves, deltas)]
+                i = int(np.argmax(deltas))
+                if deltas[i] == -np.inf:
+                    break
+                if method == 'hill-climbing' and deltas[i] <= 1e-9:
+                    break
+                operation, u, v, changed = moves[i]
+                for w, p in changed:
+                    parents[w] = list(p)
+                score += deltas[i]
+                if operation == 'reverse':
+                    tabu.append(('reverse', v, u))
+                else:
+                    tabu.append((undo[operation], u, v))
+                if score > best[1] + 1e-9:
+                    best = (dict([(w, list(p)) for w, p in parents.items()]),
+                            score)
+                    stale = 0
+                else:
+                    stale += 1
+                    if stale >= patience:
+                        break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return best
+
+
+def learn_structure(data, columns=None, score='bic', method='hill-climbing',
+                    ess=1.0, maxParents=3, tabuLength=10, patience=10,
+                    maxIter=1000, workers=None, alpha=0.0, name='learned'):
+    """Returns a DiscreteBayesNet whose structure is found by a
+    StructureSearch over data and whose CPTs are fitted to it with alpha
+    added to every count. data is a CSV file name, a dict of columns or a
+    2-D array of rows named by columns."""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    codes, levels, n = encode_table(data, columns)
+    search = StructureSearch(codes, levels, score, ess, maxParents)
+    parents, total = search.search(method, None, maxIter, tabuLength,
+                                   patience, workers)
+    learner = CPTLearner(parents, levels)
+    learner.addCounts(search.index)
+    cpts = learner.cpts(alpha)
+    order = []
+    placed = set()
+    while len(order) < len(parents):
+        for v in sorted(parents):
+            if v not in placed and placed.issuperset(parents[v]):
+                order.append(v)
+                placed.add(v)
+    nodes = []
+    for v in order:
+        node = DiscreteBayesNode(v, list(parents[v]))
+        node.setNodeCPT(cpts[v])
+        nodes.append(node)
+    return DiscreteBayesNet(nodes, name)
+
 
 
 class DiscreteCPT(object):
@@ -239,6 +2010,8 @@ class DiscreteCPT(object):
 
     nrtwork"""
 
+    __slots__ = ('myVals', 'probTable', '_factorCache')
+
     def __init__(self, vals, probTable):
 
         self.myVals = vals
@@ -251,6 +2024,62 @@ class DiscreteCPT(object):
 
                 self.probTable = probTable
 
+        self._factorCache = None
+
+    def __getstate__(self):
+        return {'myVals': self.myVals, 'probTable': self.probTable}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = state[-1]
+        for k, v in state.items():
+            if k != '_factorCache':
+                setattr(self, k, v)
+        self._factorCache = None
+
+    def toFactor(self, var, parents, parentLevels):
+        """This method returns the CPT as a Factor over the parents and the
+        variable var, in that axis order. parentLevels gives the list of
+        values of each parent. The dense table is built once and reused
+        until the variable, the parents or their values change; entries
+        missing from the probability table are 0."""
+        key = (var, tuple(parents),
+               tuple([tuple(l) for l in parentLevels]), tuple(self.myVals))
+        cache = getattr(self, '_factorCache', None)
+        if cache is not None and cache[0] == key:
+            return cache[1]
+        domains = dict(zip(parents, parentLevels))
+        domains[var] = self.myVals
+        factor = Factor(list(parents) + [var], domains,
+                        self._dense(parentLevels))
+        self._factorCache = (key, factor)
+        return factor
+
+    def _dense(self, parentLevels):
+        """Returns the CPT as an array with one axis per parent, whose values
+        are given by parentLevels, followed by an axis over the values of
+        the variable"""
+        shape = [len(l) for l in parentLevels] + [len(self.myVals)]
+        values = np.zeros(shape)
+        positions = [dict([(v, i) for i, v in enumerate(l)])
+                     for l in parentLevels]
+        for parentVals, probs in self.probTable.items():
+            index = tuple([positions[i][v] for i, v in enumerate(parentVals)])
+            values[index] = probs
+        return values
+
+    def compact(self, parentLevels):
+        """This method returns the CPT as a CompactCPT, given the list of
+        values of each parent"""
+        return CompactCPT(self.myVals, parentLevels,
+                          self._dense(parentLevels))
+
+    def table(self):
+        """This method returns a copy of the probability table, so that
+        editing it cannot bypass the factor cache; changes to a CPT go
+        through setNodeCPT"""
+        return dict([(k, list(v)) for k, v in self.probTable.items()])
+
   
 
     def values(self):
@@ -285,12 +2114,98 @@ class DiscreteCPT(object):
 
                     enumerate(self.probTable[parentVals])]) 
 
-    
+
+
+class CPTView(collections.Mapping):
+    """A read-only dict view of the probability table of a CompactCPT,
+    mapping tuples of parent values to lists of probabilities that are read
+    from the buffer of the CPT on access"""
+    __slots__ = ('cpt',)
+
+    def __init__(self, cpt):
+        self.cpt = cpt
+
+    def __getitem__(self, parentVals):
+        cpt = self.cpt
+        if not isinstance(parentVals, tuple) or \
+                len(parentVals) != len(cpt.parentLevels):
+            raise KeyError(parentVals)
+        row = 0
+        for levels, v in zip(cpt.parentLevels, parentVals):
+            try:
+                row = row * len(levels) + list(levels).index(v)
+            except ValueError:
+                raise KeyError(parentVals)
+        k = len(cpt.myVals)
+        return cpt.buffer[row * k:(row + 1) * k].tolist()
+
+    def __iter__(self):
+        return itertools.product(*self.cpt.parentLevels)
+
+    def __len__(self):
+        size = 1
+        for levels in self.cpt.parentLevels:
+            size *= len(levels)
+        return size
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class CompactCPT(DiscreteCPT):
+    """A DiscreteCPT whose probabilities are held in a single array('d')
+    buffer, one row per mixed-radix index of the parent values with the
+    last parent varying fastest. probTable is a CPTView over the buffer."""
+    __slots__ = ('parentLevels', 'buffer')
+
+    def __init__(self, vals, parentLevels, values):
+        self.myVals = vals
+        self.parentLevels = list(parentLevels)
+        self.buffer = array.array('d')
+        self.buffer.fromstring(np.ascontiguousarray(values, dtype=float)
+                               .tostring())
+        self._factorCache = None
+
+    @property
+    def probTable(self):
+        return CPTView(self)
+
+    def __getstate__(self):
+        return {'myVals': self.myVals, 'parentLevels': self.parentLevels,
+                'values': self.buffer.tolist()}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = state[-1]
+        self.myVals = state['myVals']
+        self.parentLevels = state['parentLevels']
+        self.buffer = array.array('d', state['values'])
+        self._factorCache = None
+
+    def _dense(self, parentLevels):
+        if [list(l) for l in parentLevels] != \
+                [list(l) for l in self.parentLevels]:
+            return DiscreteCPT._dense(self, parentLevels)
+        return np.frombuffer(self.buffer).reshape(
+            [len(l) for l in parentLevels] + [len(self.myVals)])
+
+    def compact(self, parentLevels):
+        if [list(l) for l in parentLevels] == \
+                [list(l) for l in self.parentLevels]:
+            return self
+        return DiscreteCPT.compact(self, parentLevels)
+
+    def table(self):
+        return self.probTable
+
+
 
 class DiscreteBayesNode(object):
 
     """A node in a Bayesian Network of discrete valued variables."""
 
+    __slots__ = ('name', 'parents', 'cpt', '_version', '_networks')
+
     def __init__(self,name,parents):
 
         self.name=name
@@ -299,6 +2214,46 @@ class DiscreteBayesNode(object):
 
         self.cpt = DiscreteCPT([],{})
 
+        self._version = 0
+
+        self._networks = None
+
+    @property
+    def version(self):
+        return getattr(self, '_version', 0)
+
+    @version.setter
+    def version(self, value):
+        """Setting the version also bumps the version of every network
+        watching the node"""
+        self._version = value
+        for bn in list(getattr(self, '_networks', None) or ()):
+            bn.version += 1
+
+    def watch(self, bn):
+        """This method makes later changes to the node bump the version of
+        the network bn, which is held by a weak reference"""
+        if getattr(self, '_networks', None) is None:
+            self._networks = weakref.WeakSet()
+        self._networks.add(bn)
+
+    def unwatch(self, bn):
+        """This method stops changes to the node from reaching bn"""
+        if getattr(self, '_networks', None) is not None:
+            self._networks.discard(bn)
+
+    def __getstate__(self):
+        return {'name': self.name, 'parents': self.parents, 'cpt': self.cpt,
+                'version': self.version}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = state[-1]
+        self.name = state['name']
+        self.parents = state['parents']
+        self.cpt = state['cpt']
+        self.version = state.get('version', 0)
+
      
 
     def getNodeName(self):
@@ -321,10 +2276,18 @@ class DiscreteBayesNode(object):
 
         """This method can be used to set/change the levels/values of the
 
-        node"""
+        node. A CompactCPT is turned back into a DiscreteCPT first, as its
+
+        buffer is laid out for the old values."""
+
+        if isinstance(self.cpt, CompactCPT):
+
+            self.cpt = DiscreteCPT(self.cpt.myVals, dict(self.cpt.probTable))
 
         self.cpt.myVals = newVals
 
+        self.version += 1
+
     
 
     def getNodeCPT(self):
@@ -333,11 +2296,13 @@ class DiscreteBayesNode(object):
 
         if the form of a dictionary with keys as values of all combinations of
 
-        parent nodes ."""
+        parent nodes . The table is a copy, or a read-only view for a
+
+        CompactCPT, so changes must be made with setNodeCPT."""
 
         '''print "The conditional probability table of " + self.name + " conditioned on parents " + str(self.parents) + " is :"'''
 
-        return self.cpt.probTable
+        return self.cpt.table()
 
 
 
@@ -349,6 +2314,8 @@ class DiscreteBayesNode(object):
 
         self.cpt = cpt
 
+        self.version += 1
+
     
 
 
@@ -357,6 +2324,36 @@ class DiscreteBayesNet(object):
 
     """A Bayesian network with a collection of nodes"""
 
+    engine = 'junctiontree'
+
+    ordering = 'min-fill'
+
+    enumerationMemo = None
+
+    executor = None
+
+    executorWorkers = None
+
+    executorCutoff = 100000
+
+    _pool = None
+
+    _watching = False
+
+    prune = True
+
+    version = 0
+
+    resultCacheSize = 1024
+
+    resultCache = None
+
+    _parents = None
+
+    _children = None
+
+    _order = None
+
     def __init__(self,nodes,name):
 
         self.nodes=nodes
@@ -375,21 +2372,13 @@ class DiscreteBayesNet(object):
 
         in the Bayesian Network"""
 
-        if node not in self.nodes:
+        if self.variables.get(node.name) is not node:
 
             print "The given node is not present in the network"
 
         else:
 
-            children=[]
-
-            for other in self.nodes:
-
-                if node.name in self.getParents(other):
-
-                    children.append(other.name)
-
-            return children
+            return list(self._adjacency()[1].get(node.name, []))
 
     
 
@@ -399,7 +2388,11 @@ class DiscreteBayesNet(object):
 
         tempnode=node
 
-        for i in self.nodes:
+        parents, children = self._adjacency()
+
+        for child in children.get(node.name, []):
+
+            i = self.variables[child]
 
             for j in range(len(i.parents)):
 
@@ -407,21 +2400,37 @@ class DiscreteBayesNet(object):
 
                     i.parents[j]=newname
 
+            parents[child] = list(i.parents)
+
+        for p in node.parents:
+
+            children[p] = [newname if c == node.name else c
+
+                           for c in children[p]]
+
+        parents[newname] = parents.pop(node.name, list(node.parents))
+
+        children[newname] = children.pop(node.name, [])
+
+        self._order = None
+
         del self.variables[node.name]
 
         self.variables[newname]=tempnode
 
         node.name=newname
 
+        self.version += 1
+
     
 
-    def getMarginal(self, var):
+    def getMarginal(self, var, engine=None):
 
-        """This method returns the marginal distribution of a given node"""
+        """This method returns the marginal distribution of a given node.
 
-        self.evidence={}
+        The evidence held by the network is left in place."""
 
-        marginal = self.query_ask(var,self.evidence)
+        marginal = self.query_ask(var,{},engine)
 
         return marginal
 
@@ -439,15 +2448,13 @@ class DiscreteBayesNet(object):
 
         in the network."""
 
-        if node not in self.nodes:
+        if self.variables.get(node.name) is not node:
 
             print "The given node is not present in the network"
 
         else:
 
-            structure = self.displayStructure()
-
-            return structure[node.getNodeName()]
+            return [str(p) for p in self._adjacency()[0][node.name]]
 
           
 
@@ -489,7 +2496,7 @@ class DiscreteBayesNet(object):
 
       
 
-    def BayesInference(self,var):
+    def BayesInference(self,var,engine=None):
 
         """This method takes the query variable as argument and computes the 
 
@@ -497,7 +2504,7 @@ class DiscreteBayesNet(object):
 
         e = self.getEvidence()
 
-        result=self.query_ask(var,e)
+        result=self.query_ask(var,e,engine)
 
         return result
 
@@ -509,7 +2516,7 @@ class DiscreteBayesNet(object):
 
     
 
-    def query_ask(self,var,e):        
+    def query_ask(self,var,e,engine=None):        
 
         """Returns a dict giving value:probability mappings for a variable,
 
@@ -517,97 +2524,894 @@ class DiscreteBayesNet(object):
 
         var is the string giving the target variable's name.  e is a dict giving
 
-        variable:value mappings for known values in the network."""
+        variable:value mappings for known values in the network.
 
-        
+        engine selects the inference algorithm, one of 'elimination',
 
-        vals = self.variables[var].cpt.values()
+        'junctiontree', 'circuit', 'likelihood' (approximate) or
 
+        'enumeration'; it defaults to the engine attribute of the network.
 
-        dist = {}
+        Large enumerations run in the 'thread' or 'process' pool named by
 
-        if var in e:
+        the executor attribute, which stays up until close is called.
 
-            for v in vals:
+        Answers are kept in an LRU cache of resultCacheSize entries until
 
-                dist[v] = 1.0 if e[var]==v else 0.0
+        the network or one of its nodes changes."""
 
-            return dist
+        if engine is None:
 
-            
+            engine = self.engine
 
-        for v in vals:
+        cache = self._resultCache()
 
-            dist[v] = self.query_all(self.variables,extend(e, var, v))
+        if cache is None:
 
-        normalize(dist)
+            return self._answer(var, e, engine)
 
-        return dist
+        key = (var, frozenset(e.items()), engine)
 
-      
+        dist = cache.get(key)
 
-    def query_all(self, vars, e, v=None):
+        if dist is None:
 
-        """A helper method for the query_ask method.  Gives the probability
+            dist = self._answer(var, e, engine)
 
-        of the evidence in e over the variables named in vars."""
+            cache.put(key, dist)
 
+        return dict(dist)
 
-        if len(vars) == 0:
+    def _answer(self, var, e, engine):
 
-            return 1.0
+        """Computes the answer of query_ask without consulting the result
 
-            
+        cache"""
 
-        if v:
+        vals = self.variables[var].cpt.values()
 
-            Y = v
 
-        else:
+        dist = {}
 
-            Y = vars.keys()[0]
+        if var in e:
 
+            for v in vals:
 
-        Ynode = self.variables[Y]
+                dist[v] = 1.0 if e[var]==v else 0.0
 
+            return dist
 
-        parents = Ynode.parents
+        if engine == 'elimination':
 
-        cpt = Ynode.cpt
+            return self.query_ve(var, e)
 
-        
+        elif engine == 'junctiontree':
 
-        for p in parents:
+            return self.query_many([var], e)[var]
 
-            if p not in e: 
+        elif engine == 'likelihood':
 
-                return self.query_all(vars, e, p)
+            return self.query_lw(var, e)[0]
 
-        
+        elif engine == 'circuit':
 
-        if Y in e:
+            return self.query_circuit_marginals(e)[var]
 
-            y = e[Y]
+        elif engine != 'enumeration':
 
-            cp = cpt.prob_dist([e[p] for p in parents])[y]
+            raise ValueError("Unknown inference engine " + str(engine))
 
-            result = cp * self.query_all(cut(vars,Y), e)
+        compiled = self.compile()
 
+        relevant = [compiled.names[i] for i in
+
+                    compiled.relevant(compiled.position[var],
+
+                                      compiled.encode(e))]
+
+            
+
+        if (self.executor is not None and
+                self._enumerationWork(relevant, e) >= self.executorCutoff):
+            dist = self._parallelEnumeration(var, vals, relevant, e)
         else:
+            for v in vals:
+
+                dist[v] = self.query_all(relevant,extend(e, var, v))
 
-            result = 0
+        normalize(dist)
+
+        return dist
 
-            for y in Ynode.cpt.values():
+      
 
-                cp = cpt.prob_dist([e[p] for p in parents])[y]
+    def query_all(self, vars, e, v=None):
+        """A helper method for the query_ask method.  Gives the probability
+        of the evidence in e over the variables named in vars, enumerated in
+        place on a cached integer plan and memoized when the enumeration memo
+        is enabled. v is accepted for compatibility and ignored."""
+        return self._enumerate(vars, e, self.enumerationMemo)
+
+    def _enumerationWork(self, vars, e):
+        """Returns the number of leaves of the enumeration tree over the
+        variables named in vars given the evidence e, the estimate of work
+        compared with executorCutoff"""
+        work = 1
+        for name in vars:
+            if name not in e:
+                work *= len(self.variables[name].cpt.values())
+        return work
+
+    def _parallelEnumeration(self, var, vals, relevant, e):
+        """Returns the query_all sums for every value of var, split over
+        further free variables until there is a job per worker and run in
+        the executor pool. The enumeration holds the GIL, so only the
+        'process' executor makes it faster."""
+        workers = self.executorWorkers or multiprocessing.cpu_count()
+        jobs = [(v, extend(e, var, v)) for v in vals]
+        free = [name for name in relevant if name not in e and name != var]
+        while len(jobs) < workers and free:
+            split = free.pop(0)
+            jobs = [(v, extend(evidence, split, x)) for v, evidence in jobs
+                    for x in self.variables[split].cpt.values()]
+        pool = self._executorPool(workers)
+        if self.executor == 'thread':
+            function = self._enumerationJob
+        else:
+            function = enumeration_sum
+        sums = pool.map(function, [(relevant, evidence)
+                                   for v, evidence in jobs])
+        dist = dict([(v, 0.0) for v in vals])
+        for (v, evidence), p in zip(jobs, sums):
+            dist[v] += p
+        return dist
 
-                result += cp * self.query_all(cut(vars,Y),extend(e, Y, y))
+    def _executorPool(self, workers):
+        """Returns the pool of _parallelEnumeration, kept until close is
+        called and restarted when the executor, the number of workers or,
+        for processes holding a copy of the network, the network changes"""
+        if self.executor == 'thread':
+            key = ('thread', workers)
+        elif self.executor == 'process':
+            key = ('process', workers, self._modelKey())
+        else:
+            raise ValueError("Unknown executor " + str(self.executor))
+        if self._pool is not None and self._pool[0] == key:
+            return self._pool[1]
+        self.close()
+        if self.executor == 'thread':
+            pool = multiprocessing.pool.ThreadPool(workers)
+        else:
+            pool = multiprocessing.Pool(workers, _init_worker, (self,))
+        self._pool = (key, pool)
+        return pool
+
+    def close(self):
+        """This method shuts down the worker pool of the executor, if one
+        is running. A later query that needs it starts a new one."""
+        if self._pool is not None:
+            pool = self._pool[1]
+            self._pool = None
+            pool.close()
+            pool.join()
+
+    def _enumerationJob(self, job):
+        """Returns query_all for a (variables, evidence) job of
+        _parallelEnumeration, with a fresh enumeration memo when the memo
+        is enabled"""
+        vars, e = job
+        memo = self.enumerationMemo
+        if memo is not None:
+            memo = LRUCache(memo.maxsize)
+        return self._enumerate(vars, e, memo)
+
+    def _enumerate(self, vars, e, memo):
+        """Computes query_all with the given enumeration memo, or without
+        one when memo is None. The memo is emptied first if the network has
+        changed since it was last used."""
+        compiled = self.compile()
+        if memo is not None:
+            memo.validate(compiled.key)
+        codes = compiled.encode(e)
+        plan = compiled.enumerationPlan([compiled.position[v] for v in vars],
+                                        codes)
+        n = len(plan.codes)
+        fixed = [codes.get(c, -1) for c in plan.codes]
+        base = [0] * n
+        for i in range(n):
+            for parent, stride in plan.external[i]:
+                base[i] += codes[parent] * stride
+        assignment = [0] * n
+        tables = plan.tables
+        internal = plan.internal
+        if memo is not None:
+            evidenceKeys = [(plan.key, i, tuple([(k, codes[k])
+                                                  for k in plan.relevant[i]]))
+                            for i in range(n)]
+            frontier = plan.frontier
+
+        def enumerate_from(i):
+            if i == n:
+                return 1.0
+            if memo is not None:
+                key = (evidenceKeys[i],
+                       tuple([assignment[j] for j in frontier[i]]))
+                result = memo.get(key)
+                if result is not None:
+                    return result
+            index = base[i]
+            for j, stride in internal[i]:
+                index += assignment[j] * stride
+            row = tables[i][index]
+            if fixed[i] >= 0:
+                p = row[fixed[i]]
+                assignment[i] = fixed[i]
+                result = p * enumerate_from(i + 1) if p else 0.0
+            else:
+                result = 0.0
+                for y, p in enumerate(row):
+                    if p:
+                        assignment[i] = y
+                        result += p * enumerate_from(i + 1)
+            if memo is not None:
+                memo.put(key, result)
+            return result
+        return enumerate_from(0)
+
+    def addEvidence(self, var, value):
+        """This method sets or changes the hard evidence on a single
+        variable. With the default 'junctiontree' engine, BayesInference
+        afterwards only re-propagates the part of the tree affected by that
+        variable."""
+        self.evidence[var] = value
+
+    def retractEvidence(self, var):
+        """This method removes the hard evidence on a single variable, if
+        any"""
+        if var in self.evidence:
+            del self.evidence[var]
+
+    def learnCPTs(self, data, chunkSize=100000, alpha=0.0):
+        """This method sets the CPTs of all nodes to their maximum likelihood
+        estimates, with alpha added to every count, from a CSV file read
+        chunkSize rows at a time or an iterable of chunks of columns, and
+        returns the CPTLearner holding the counts."""
+        learner = CPTLearner(self.displayStructure(),
+                             dict([(node.name, node.cpt.values())
+                                   for node in self.nodes]))
+        if isinstance(data, basestring):
+            data = read_csv_chunks(data, chunkSize)
+        for chunk in data:
+            learner.update(chunk)
+        for var, cpt in learner.cpts(alpha).items():
+            self.setNodeCPT(self.variables[var], cpt)
+        return learner
+
+    def learnEM(self, data, columns=None, maxIter=50, tol=1e-6, alpha=0.0,
+                workers=None, shardRows=None, batchSize=2048,
+                checkpoint=None, seed=None):
+        """This method fits the CPTs to data with missing entries by EM, with
+        E-steps over shards of shardRows records in a pool of workers
+        processes, and returns the log-likelihood of every iteration. data
+        is given as for query_batch or as a CSV file name; alpha smooths the
+        M-step and checkpoint names a file to save to and resume from."""
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        levels = dict([(node.name, list(node.cpt.values()))
+                       for node in self.nodes])
+        fixed = set([v for v in levels if levels[v]])
+        codes, levels, n = encode_table(data, columns, levels)
+        for v in levels:
+            if not levels[v]:
+                raise ValueError("No values found for " + v)
+            if v not in fixed:
+                self.variables[v].setNodeLevels(levels[v])
+        structure = self.displayStructure()
+        learner = CPTLearner(structure, levels)
+        rng = np.random.RandomState(seed)
+        for node in self.nodes:
+            if not node.cpt.probTable or not any(node.cpt.probTable.values()):
+                shape = learner._shape(node.name)
+                learner.counts[node.name] = rng.dirichlet(
+                    np.ones(shape[-1]), int(np.prod(shape[:-1]))).reshape(shape)
+                self.setNodeCPT(node, learner.cpts()[node.name])
+        trace = []
+        if checkpoint is not None and os.path.exists(checkpoint):
+            f = open(checkpoint, 'rb')
+            try:
+                state = cPickle.load(f)
+            finally:
+                f.close()
+            trace = state['trace']
+            for v, (values, table) in state['cpts'].items():
+                self.setNodeCPT(self.variables[v], DiscreteCPT(values, table))
+        if shardRows is None:
+            shardRows = max(1, int(np.ceil(float(n) / workers)))
+        shards = [dict([(v, c[start:start+shardRows])
+                        for v, c in codes.items()])
+                  for start in range(0, n, shardRows)]
+        families = [learner.family(node.name) for node in self.nodes]
+        factors = [self._nodeFactor(node) for node in self.nodes]
+        order = elimination_order(factors, list(self.variables), self.ordering)
+        pool = None
+        if workers > 1 and len(shards) > 1:
+            pool = multiprocessing.Pool(workers, _init_worker, (shards,))
+        try:
+            while len(trace) < maxIter:
+                if len(trace) > 1 and \
+                        trace[-1] - trace[-2] < tol * abs(trace[-2]):
+                    break
+                jt = JunctionTree([self._nodeFactor(node)
+                                   for node in self.nodes], order)
+                if pool is None:
+                    results = [em_expectations((jt, families, shard,
+                                                batchSize))
+                               for shard in shards]
+                else:
+                    results = pool.map(em_expectations,
+                                       [(jt, families, i, batchSize)
+                                        for i in range(len(shards))])
+                trace.append(float(sum([r[1] for r in results])))
+                for i, node in enumerate(self.nodes):
+                    learner.counts[node.name] = sum([r[0][i] for r in results])
+                for v, cpt in learner.cpts(alpha).items():
+                    self.setNodeCPT(self.variables[v], cpt)
+                if checkpoint is not None:
+                    f = open(checkpoint + '.tmp', 'wb')
+                    try:
+                        cPickle.dump({'trace': trace,
+                                      'cpts': dict([(node.name,
+                                                     (node.cpt.values(),
+                                                      node.cpt.probTable))
+                                                    for node in self.nodes])},
+                                     f, cPickle.HIGHEST_PROTOCOL)
+                    finally:
+                        f.close()
+                    os.rename(checkpoint + '.tmp', checkpoint)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return trace
+
+    def compact(self):
+        """This method converts the CPT of every node to a CompactCPT, which
+        holds its probabilities in a single array buffer. This cuts the
+        memory taken by the CPTs of large networks several times over, while
+        getNodeCPT keeps returning a dict view of each table."""
+        for node in self.nodes:
+            parentLevels = [self.variables[p].cpt.values()
+                            for p in node.parents]
+            cpt = node.cpt.compact(parentLevels)
+            if cpt is not node.cpt:
+                self.setNodeCPT(node, cpt)
+
+    def setNodeCPT(self, node, cpt):
+        """This method sets the conditional probability distribution of a
+        node of the network and invalidates the cached results"""
+        node.setNodeCPT(cpt)
+        self.version += 1
+
+    def cacheStats(self):
+        """This method returns the size, hit and miss counts and hit rate of
+        the result cache of query_ask"""
+        cache = self._resultCache()
+        if cache is None:
+            return {}
+        return cache.stats()
+
+    def _resultCache(self):
+        """Returns the result cache, emptied if the network has changed since
+        it was last used, or None when resultCacheSize is 0"""
+        if not self.resultCacheSize:
+            return None
+        if self.resultCache is None or \
+                self.resultCache.maxsize != self.resultCacheSize:
+            self.resultCache = LRUCache(self.resultCacheSize)
+        self.resultCache.validate(self._modelKey())
+        return self.resultCache
+
+    def useEnumerationMemo(self, maxsize=100000):
+        """This method enables memoization of the sub-results of the
+        enumeration engine in an LRU cache holding at most maxsize entries,
+        or disables it when maxsize is 0. The cache and its hit and miss
+        counters are available as the enumerationMemo attribute."""
+        if maxsize:
+            self.enumerationMemo = LRUCache(maxsize)
+        else:
+            self.enumerationMemo = None
+
+    def query_ve(self, var, e):
+        """Returns the same value:probability dict as query_ask, computed by
+        variable elimination over the CPTs that can affect the answer, in the
+        order chosen by the ordering heuristic of the network"""
+        compiled = self.compile()
+        q = compiled.position[var]
+        codes = compiled.encode(e)
+        factors = [compiled.factors[i].reduce(codes)
+                   for i in compiled.relevant(q, codes)]
+        hidden = set()
+        for f in factors:
+            hidden.update(f.variables)
+        hidden.discard(q)
+        order = compiled.eliminationOrder(q, codes, factors, sorted(hidden))
+        result = eliminate(factors, order)
+        return compiled.decode(q, result.normalize().values)
+
+    def query_lw(self, var, e, samples=None, targetError=None,
+                 batchSize=10000, maxSamples=10000000, seed=None):
+        """Returns an approximation of the posterior of var given e by likelihood
+        weighting over the relevant nodes, drawn batchSize at a time, together
+        with the number of samples, the effective sample size and the standard
+        error. Sampling stops after samples draws or once the standard error is
+        below targetError, and after maxSamples draws at most."""
+        if samples is None and targetError is None:
+            samples = 100000
+        plan = self.compile()
+        rng = np.random.RandomState(seed)
+        q = plan.position[var]
+        k = len(plan.levels[q])
+        evidence = plan.encode(e)
+        relevant = plan.relevant(q, evidence)
+        sampled = [i for i in relevant if i not in evidence]
+        weighted = set([i for i in relevant if i in evidence])
+        fixed = evidence.items()
+        shift = None
+        sums = np.zeros(k)
+        squares = 0.0
+        n = 0
+        while True:
+            size = batchSize
+            if samples is not None:
+                size = min(size, samples - n)
+            size = min(size, maxSamples - n)
+            if size <= 0:
+                break
+            codes = np.zeros((size, len(plan.names)), dtype=int, order='F')
+            for i, code in fixed:
+                codes[:, i] = code
+            logw = np.zeros(size)
+            for i in sorted(sampled + list(weighted)):
+                if i in weighted:
+                    rows = plan.rowIndex(codes, i)
+                    with np.errstate(divide='ignore'):
+                        logw += np.log(plan.probs[i][rows, codes[0, i]])
+                else:
+                    plan.draw(codes, i, rng)
+            top = logw.max()
+            if np.isfinite(top):
+                if shift is None or top > shift:
+                    if shift is not None:
+                        sums *= np.exp(shift - top)
+                        squares *= np.exp(2 * (shift - top))
+                    shift = top
+                w = np.exp(logw - shift)
+                sums += np.bincount(codes[:, q], weights=w, minlength=k)
+                squares += (w * w).sum()
+            n += size
+            total = sums.sum()
+            ess = total * total / squares if squares else 0.0
+            if targetError is not None and ess > 0:
+                p = sums / total
+                if np.sqrt(p * (1 - p) / ess).max() <= targetError:
+                    break
+        total = sums.sum()
+        p = sums / total if total else sums
+        ess = total * total / squares if squares else 0.0
+        error = np.sqrt(p * (1 - p) / ess).max() if ess else float('inf')
+        dist = dict(zip(plan.levels[q], p.tolist()))
+        return dist, {'samples': n, 'ess': ess, 'stderr': error}
+
+    def query_gibbs(self, var, e, samples=100000, burnIn=500, workers=None,
+                    chainsPerWorker=32, seed=None):
+        """Returns an approximation of the posterior of var given e by Gibbs
+        sampling in blocks of chainsPerWorker chains over a pool of workers
+        processes, together with a dict of diagnostics: the sample and chain
+        counts, R-hat, the timing, the zeroMass sweeps left out and whether
+        the evidence is impossible, which gives an all-zero posterior."""
+        start = time.time()
+        if var in e:
+            return self._answer(var, e, 'elimination'), {}
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        plan = self.compile()
+        target = plan.position[var]
+        evidence = plan.encode(e)
+        relevant = plan.relevant(target, evidence)
+        factors = [plan.factors[i] for i in relevant]
+        free = [i for i in relevant if i not in evidence]
+        position = dict([(i, j) for j, i in enumerate(free)])
+        tables = []
+        for X in free:
+            joint = None
+            for f in factors:
+                if X in f.variables:
+                    joint = f if joint is None else joint.product(f)
+            joint = joint.reduce(evidence)
+            blanket = [v for v in joint.variables if v != X]
+            values = joint._aligned(blanket + [X]).reshape(-1, len(joint.domains[X]))
+            strides = np.ones(len(blanket), dtype=int)
+            for j in range(len(blanket) - 2, -1, -1):
+                strides[j] = strides[j+1] * len(joint.domains[blanket[j+1]])
+            tables.append((position[X], [position[b] for b in blanket],
+                           strides, np.cumsum(values, axis=1)))
+        chains = workers * chainsPerWorker
+        sweeps = max(1, int(np.ceil(float(samples) / chains)))
+        rng = np.random.RandomState(seed)
+        codes = np.zeros((chains, len(plan.names)), dtype=int, order='F')
+        for i, value in evidence.items():
+            codes[:, i] = value
+        for i in free:
+            plan.draw(codes, i, rng)
+        init = codes[:, free]
+        q = position[target]
+        k = len(plan.levels[target])
+        jobs = [(tables, init[w*chainsPerWorker:(w+1)*chainsPerWorker],
+                 sweeps, burnIn, q, k, rng.randint(2**31 - 1))
+                for w in range(workers)]
+        if workers == 1:
+            counts = [gibbs_chains(jobs[0])]
+        else:
+            pool = multiprocessing.Pool(workers)
+            try:
+                counts = pool.map(gibbs_chains, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        zeroMass = np.concatenate([z for c, z in counts])
+        counts = np.vstack([c for c, z in counts])
+        total = counts.sum(axis=0)
+        impossible = total.sum() == 0 or \
+            any([not f.reduce(evidence).values for f in factors
+                 if all([v in evidence for v in f.variables])])
+        if impossible:
+            p = np.zeros(k)
+        else:
+            p = total / total.sum()
+        seconds = time.time() - start
+        dist = plan.decode(target, p)
+        return dist, {'samples': int(total.sum()), 'chains': chains,
+                      'rhat': float('nan') if impossible else
+                      potential_scale_reduction(counts[zeroMass == 0]),
+                      'seconds': seconds,
+                      'samplesPerSecond': chains * (sweeps + burnIn) / seconds,
+                      'zeroMass': int(zeroMass.sum()),
+                      'impossible': bool(impossible)}
+
+    def sampleRows(self, n, batchSize=100000, seed=None):
+        """Generates n forward samples of the network as 2-D arrays of at
+        most batchSize rows, with one column per node in the order of
+        self.nodes holding integer codes into the node's levels. Nodes are
+        drawn in topological order, one vectorized draw per node and batch,
+        and only one batch is held in memory at a time."""
+        plan = self.compile()
+        rng = np.random.RandomState(seed)
+        columns = [plan.position[node.name] for node in self.nodes]
+        for start in range(0, n, batchSize):
+            codes = np.empty((min(batchSize, n - start), len(plan.names)),
+                             dtype=int, order='F')
+            for i in range(len(plan.names)):
+                plan.draw(codes, i, rng)
+            yield codes[:, columns]
+
+    def writeSamplesCSV(self, filename, n, batchSize=100000, seed=None):
+        """This method streams n forward samples of the network to a CSV
+        file with a header row of node names and the sampled values of the
+        nodes in the following rows"""
+        levels = [np.array(node.cpt.values(), dtype=object)
+                  for node in self.nodes]
+        f = open(filename, 'wb')
+        try:
+            writer = csv.writer(f)
+            writer.writerow([node.name for node in self.nodes])
+            for codes in self.sampleRows(n, batchSize, seed):
+                writer.writerows(zip(*[l[codes[:, j]]
+                                       for j, l in enumerate(levels)]))
+        finally:
+            f.close()
 
+    def writeSamplesNpy(self, prefix, n, shardRows=1000000, seed=None):
+        """This method streams n forward samples of the network to .npy
+        shards of at most shardRows rows of integer codes, named prefix
+        followed by the shard number, and writes the node names and levels
+        needed to decode them to prefix_meta.json. Returns the list of shard
+        file names."""
+        names = []
+        for i, codes in enumerate(self.sampleRows(n, shardRows, seed)):
+            names.append('%s_%05d.npy' % (prefix, i))
+            np.save(names[-1], codes.astype(np.int32))
+        f = open(prefix + '_meta.json', 'w')
+        try:
+            json.dump({'columns': [node.name for node in self.nodes],
+                       'levels': [list(node.cpt.values())
+                                  for node in self.nodes],
+                       'rows': n, 'shards': names}, f)
+        finally:
+            f.close()
+        return names
+
+    def query_mpe(self, e):
+        """Returns the most probable explanation of the hard evidence e, as a
+        pair of a dict giving a value for every variable of the network and
+        the joint probability of that assignment"""
+        return self.query_map(self.variables.keys(), e)
+
+    def query_map(self, vars, e):
+        """Returns the most probable joint values of the variables named in
+        vars given the hard evidence e, as a dict of variable:value mappings,
+        and their probability jointly with the evidence, by max-product
+        elimination with backtracking."""
+        compiled = self.compile()
+        codes = compiled.encode(e)
+        free = [compiled.position[v] for v in vars if v not in e]
+        if not free:
+            relevant = compiled.mapRelevant(sorted(codes), codes)
+            factors = [compiled.factors[i].reduce(codes) for i in relevant]
+            p = 1.0
+            if factors:
+                hidden = [i for i in relevant if i not in codes]
+                order = elimination_order(factors, hidden, compiled.ordering)
+                p = eliminate(factors, order).values
+            return dict([(v, e[v]) for v in vars if v in e]), float(p)
+        factors = [compiled.factors[i].reduce(codes)
+                   for i in compiled.mapRelevant(free, codes)]
+        sumOrder, maxOrder = compiled.mapOrders(free, codes, factors, False)
+        assignment, p = max_product(factors, sumOrder, maxOrder)
+        result = dict([(v, e[v]) for v in vars if v in e])
+        for i in free:
+            result[compiled.names[i]] = compiled.levels[i][int(assignment[i])]
+        return result, float(p)
+
+    def query_map_batch(self, data, columns=None, vars=None, chunkSize=4096):
+        """Returns the most probable joint values of the variables named in vars,
+        all the nodes by default, for every evidence record in data, given as
+        for query_batch, as a 2-D array of codes with one column per variable
+        and an array of their probabilities jointly with each record's evidence."""
+        if vars is None:
+            vars = [node.name for node in self.nodes]
+        compiled = self.compile()
+        targets = [compiled.position[v] for v in vars]
+        codes, n = self._encodeColumns(data, columns)
+        values = np.empty((n, len(vars)), dtype=int)
+        probs = np.empty(n)
+        for start in range(0, n, chunkSize):
+            chunk = dict([(c, a[start:start+chunkSize])
+                          for c, a in codes.items()])
+            size = len(chunk.values()[0]) if chunk else min(chunkSize,
+                                                             n - start)
+            domains = {BATCH: range(size)}
+            factors = [compiled.factors[i]
+                       for i in compiled.mapRelevant(targets, chunk)]
+            for i, c in chunk.items():
+                domains[i] = compiled.domains[i]
+                factors.append(Factor([BATCH, i], domains,
+                                      evidence_indicators(c, len(domains[i]))))
+            if not chunk:
+                factors.append(Factor([BATCH], domains, np.ones(size)))
+            sumOrder, maxOrder = compiled.mapOrders(targets, chunk, factors,
+                                                    True)
+            assignment, p = max_product(factors, sumOrder, maxOrder, BATCH)
+            for j, i in enumerate(targets):
+                values[start:start+size, j] = assignment[i]
+            probs[start:start+size] = p
+        return values, probs
+
+    def query_batch(self, var, data, columns=None, chunkSize=4096):
+        """Returns a NumPy array with one row per evidence record and one
+        column per value of var, giving its posterior given that record. data
+        is a dict of columns or a 2-D array of rows named by columns, holding
+        values or integer codes; None, NaN, empty strings and the code -1 mark
+        a variable as unobserved."""
+        compiled = self.compile()
+        q = compiled.position[var]
+        codes, n = self._encodeColumns(data, columns)
+        result = np.empty((n, len(compiled.levels[q])))
+        for start in range(0, n, chunkSize):
+            chunk = dict([(c, a[start:start+chunkSize])
+                          for c, a in codes.items()])
+            result[start:start+chunkSize] = self._batchPosterior(compiled, q,
+                                                                 chunk)
+        return result
 
+    def _batchPosterior(self, compiled, q, codes):
+        size = len(codes.values()[0])
+        domains = {BATCH: range(size)}
+        factors = [compiled.factors[i]
+                   for i in compiled.relevant(q, codes, False)]
+        for i, c in codes.items():
+            domains[i] = compiled.domains[i]
+            factors.append(Factor([BATCH, i], domains,
+                                  evidence_indicators(c, len(domains[i]))))
+        hidden = set()
+        for f in factors:
+            hidden.update(f.variables)
+        hidden.difference_update([q, BATCH])
+        order = compiled.eliminationOrder(q, codes, factors, sorted(hidden),
+                                          True)
+        result = eliminate(factors, order, BATCH)
+        values = np.broadcast_to(result._aligned([BATCH, q]),
+                                 (size, len(compiled.levels[q])))
+        total = values.sum(axis=1, keepdims=True)
+        total[total == 0] = 1.0
+        return values / total
+
+    def _encodeColumns(self, data, columns=None):
+        """Returns a dict mapping the codes of the variables in the compiled
+        network to integer code arrays of their values, with -1 for
+        unobserved entries, together with the number of records"""
+        if isinstance(data, dict):
+            columns = list(data.keys())
+            raw = [data[c] for c in columns]
+        else:
+            if columns is None:
+                raise ValueError("Column names are required for array data")
+            rows = np.asarray(data)
+            raw = [rows[:, i] for i in range(len(columns))]
+        compiled = self.compile()
+        codes = {}
+        n = len(raw[0]) if raw else len(data)
+        for name, col in zip(columns, raw):
+            i = compiled.position[str(name)]
+            codes[i] = encode_levels(col, list(compiled.levels[i]))
+        return codes, n
+
+    def query_all_marginals(self, evidence):
+        """Returns a dict mapping every variable of the network to its
+        posterior value:probability dict given the hard evidence. The
+        network is compiled into a junction tree once and cached, and a single
+        calibration pass serves the marginals of all nodes."""
+        return self.query_many(self.variables.keys(), evidence)
+
+    def query_lbp_marginals(self, evidence, schedule='synchronous',
+                            damping=0.0, maxIter=100, tol=1e-6):
+        """Returns an approximation of the posterior of every variable given the
+        hard evidence by loopy belief propagation on the reduced CPTs, together
+        with the number of sweeps, whether the messages converged within tol
+        and the last largest change."""
+        compiled = self.compile()
+        codes = compiled.encode(evidence)
+        lbp = LoopyBeliefPropagation([f.reduce(codes)
+                                      for f in compiled.factors])
+        iterations, converged, delta = lbp.run(schedule, damping, maxIter, tol)
+        marginals = {}
+        for i, var in enumerate(compiled.names):
+            levels = compiled.levels[i]
+            if var in evidence:
+                marginals[var] = dict([(v, 1.0 if evidence[var]==v else 0.0)
+                                       for v in levels])
+            elif i in lbp.edges:
+                marginals[var] = compiled.decode(i, lbp.marginal(i))
+            else:
+                marginals[var] = dict([(v, 1.0 / len(levels)) for v in levels])
+        return marginals, {'iterations': iterations, 'converged': converged,
+                           'delta': delta}
+
+    def query_many(self, vars, evidence):
+        """Returns a dict mapping each variable named in vars to its posterior
+        value:probability dict given the hard evidence. The variables share
+        one junction tree: only the messages towards the cliques holding the
+        requested variables are computed, each of them once, and they stay
+        cached for later queries with the same evidence."""
+        compiled = self.compile()
+        jt = compiled.junctionTree()
+        jt.setEvidence(compiled.encode(evidence))
+        result = {}
+        for var in vars:
+            i = compiled.position[var]
+            if var in evidence:
+                result[var] = dict([(v, 1.0 if evidence[var]==v else 0.0)
+                                    for v in compiled.levels[i]])
+            else:
+                result[var] = compiled.decode(i, jt.marginal(i))
+        return result
 
-        return result        
+    def junctionTree(self):
+        """Returns the junction tree of the compiled network, whose variables
+        and values are integer codes. It is compiled only when the network
+        has changed since the last compilation."""
+        return self.compile().junctionTree()
+
+    def compileCircuit(self):
+        """Returns the arithmetic circuit of the compiled network, which can
+        be saved for processes that load it with load_circuit"""
+        return self.compile().circuit()
+
+    def query_circuit_marginals(self, evidence):
+        """Returns a dict mapping every variable of the network to its
+        posterior value:probability dict given the hard evidence, from the
+        upward and downward passes of the arithmetic circuit"""
+        compiled = self.compile()
+        circuit = compiled.circuit()
+        p, marginals = circuit.posteriors(circuit.encode(evidence))
+        result = {}
+        for i, var in enumerate(compiled.names):
+            if var in evidence:
+                result[var] = dict([(v, 1.0 if evidence[var]==v else 0.0)
+                                    for v in compiled.levels[i]])
+            else:
+                result[var] = compiled.decode(i, marginals[i][0].tolist())
+        return result
 
-    
+    def compile(self):
+        """This method returns the network frozen into a CompiledNetwork, on
+        which the inference engines run. The network is compiled again only
+        when a node, its parents, values or CPT, or the ordering or prune
+        attribute has changed since the last call."""
+        key = self._modelKey()
+        compiled = getattr(self, '_compiled', None)
+        if compiled is None or compiled.key != key:
+            compiled = CompiledNetwork(self, key)
+            self._compiled = compiled
+        return compiled
+
+    def _adjacency(self):
+        """Returns the dicts mapping the name of every node to the names of
+        its parents and of its children. They are built from the nodes on
+        first use and then kept up to date by addNode, deleteNode and
+        changeNodeName."""
+        if self._children is None:
+            self._parents = dict([(node.name, list(node.parents))
+                                  for node in self.nodes])
+            self._children = dict([(node.name, []) for node in self.nodes])
+            for node in self.nodes:
+                for p in node.parents:
+                    self._children.setdefault(p, []).append(node.name)
+            self._order = None
+        return self._parents, self._children
+
+    def topologicalOrder(self):
+        """This method returns the names of the nodes ordered so that every
+        node comes after its parents. The order is computed once and kept up
+        to date as nodes are added or deleted; it raises a ValueError when the network
+        contains a directed cycle."""
+        parents, children = self._adjacency()
+        if self._order is None:
+            missing = dict([(node.name, len([p for p in node.parents
+                                             if p in self.variables]))
+                            for node in self.nodes])
+            ready = [node.name for node in self.nodes
+                     if missing[node.name] == 0]
+            order = []
+            while ready:
+                name = ready.pop()
+                order.append(name)
+                for c in children.get(name, []):
+                    missing[c] -= 1
+                    if missing[c] == 0:
+                        ready.append(c)
+            if len(order) != len(self.nodes):
+                raise ValueError("The network contains a directed cycle")
+            self._order = collections.OrderedDict([(n, True) for n in order])
+        return list(self._order)
+
+    def _modelKey(self):
+        """Returns a value that changes whenever a node is added, removed or
+        renamed, or gets new values or CPT, and whenever the ordering or
+        prune attribute changes. The nodes are made to watch the network on
+        first use, so that their changes bump its version."""
+        if not self._watching:
+            for node in self.nodes:
+                node.watch(self)
+            self._watching = True
+        return (self.version, len(self.nodes), self.ordering, self.prune)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_compiled', None)
+        state.pop('resultCache', None)
+        state.pop('enumerationMemo', None)
+        state.pop('_parents', None)
+        state.pop('_children', None)
+        state.pop('_order', None)
+        state.pop('_pool', None)
+        state.pop('_watching', None)
+        return state
+
+    def _nodeFactor(self, node):
+        """Returns the CPT of a node as a factor over its parents and the
+        node itself"""
+        parentLevels = [self.variables[p].cpt.values() for p in node.parents]
+        return node.cpt.toFactor(node.name, node.parents, parentLevels)
 
     def addNode(self,node):
 
@@ -619,15 +3423,42 @@ class DiscreteBayesNet(object):
 
             print "The argument must be an object of type node"
 
-        elif node in self.nodes:
+        elif self.variables.get(node.name) is node:
 
             print "The node is already in the network"
 
         else:
 
+            parents, children = self._adjacency()
+
             self.nodes.append(node)
 
-            self.variables=extend(self.variables,node.name,node)
+            self.variables[node.name] = node
+
+            if self._watching:
+
+                node.watch(self)
+
+            parents[node.name] = list(node.parents)
+
+            children.setdefault(node.name, [])
+
+            for p in node.parents:
+
+                children.setdefault(p, []).append(node.name)
+
+            if self._order is not None:
+
+                if all([p in self.variables for p in node.parents]) and \
+                        not children[node.name]:
+
+                    self._order[node.name] = True
+
+                else:
+
+                    self._order = None
+
+            self.version += 1
 
             
 
@@ -643,7 +3474,7 @@ class DiscreteBayesNet(object):
 
             print "The argument must be an object of type node"
 
-        elif node not in self.nodes:
+        elif self.variables.get(node.name) is not node:
 
             print "Cannot delete node. The node doesn't exist"
 
@@ -653,10 +3484,28 @@ class DiscreteBayesNet(object):
 
         else:
 
+            parents, children = self._adjacency()
+
             self.nodes.remove(node)
 
             del self.variables[node.name]
 
+            node.unwatch(self)
+
+            for p in parents.pop(node.name, []):
+
+                if p in children:
+
+                    children[p].remove(node.name)
+
+            children.pop(node.name, None)
+
+            if self._order is not None:
+
+                del self._order[node.name]
+
+            self.version += 1
+
           
 
     def displayStructure(self):
@@ -1291,7 +4140,7 @@ class SetEvidenceFrame(wx.Frame):
 
         nodevalue = self.onSelection2(e)
 
-        custom_network.evidence[nodename]=nodevalue
+        custom_network.addEvidence(nodename, nodevalue)
 
         for key in custom_network.evidence.keys():
 
@@ -1323,7 +4172,7 @@ class SetEvidenceFrame(wx.Frame):
 
         nodevalue = str(self.setnodevalue.GetValue())
 
-        custom_network.evidence[nodename]=nodevalue
+        custom_network.addEvidence(nodename, nodevalue)
 
         for key in custom_network.evidence.keys():
 
@@ -1449,7 +4298,7 @@ class RemoveEvidenceFrame(wx.Frame):
 
         else:
 
-            del custom_network.evidence[nodename]
+            custom_network.retractEvidence(nodename)
 
             evidenceList.remove(nodename)
 
@@ -0,0 +1,850 @@
+"""Checks of the inference engines of BayesNet against brute-force
+enumeration of the joint distribution of small random networks"""
+import cPickle
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import BayesNet
+
+
+def random_network(n, seed, maxParents=2, maxLevels=3):
+    """Returns a random DiscreteBayesNet over n nodes X0..X(n-1), whose
+    parents are drawn among the few nodes before them"""
+    rnd = random.Random(seed)
+    names = ['X%d' % i for i in range(n)]
+    levels = {}
+    nodes = []
+    for i, name in enumerate(names):
+        levels[name] = ['%s_%d' % (name, j)
+                        for j in range(rnd.randint(2, maxLevels))]
+        candidates = names[max(0, i - 4):i]
+        parents = rnd.sample(candidates,
+                             min(len(candidates), rnd.randint(0, maxParents)))
+        table = {}
+        for parentVals in itertools.product(*[levels[p] for p in parents]):
+            weights = [rnd.random() for v in levels[name]]
+            table[parentVals] = [w / sum(weights) for w in weights]
+        node = BayesNet.DiscreteBayesNode(name, parents)
+        node.setNodeCPT(BayesNet.DiscreteCPT(levels[name], table))
+        nodes.append(node)
+    return BayesNet.DiscreteBayesNet(nodes, 'random%d' % seed)
+
+
+def joint(bn):
+    """Generates every joint assignment of the network as a dict, together
+    with its probability"""
+    names = [node.name for node in bn.nodes]
+    for values in itertools.product(*[bn.variables[v].cpt.values()
+                                      for v in names]):
+        a = dict(zip(names, values))
+        p = 1.0
+        for node in bn.nodes:
+            parentVals = tuple([a[q] for q in node.parents])
+            p *= node.cpt.prob_dist(parentVals)[a[node.name]]
+        yield a, p
+
+
+def consistent(a, e):
+    return all([a[v] == value for v, value in e.items()])
+
+
+def brute_posterior(bn, var, e):
+    dist = dict([(v, 0.0) for v in bn.variables[var].cpt.values()])
+    for a, p in joint(bn):
+        if consistent(a, e):
+            dist[a[var]] += p
+    total = sum(dist.values())
+    if total:
+        dist = dict([(v, p / total) for v, p in dist.items()])
+    return dist
+
+
+def brute_map(bn, vars, e):
+    scores = {}
+    for a, p in joint(bn):
+        if consistent(a, e):
+            key = tuple([a[v] for v in vars])
+            scores[key] = scores.get(key, 0.0) + p
+    best = max(scores, key=scores.get)
+    return dict(zip(vars, best)), scores[best]
+
+
+def random_evidence(bn, rnd, k):
+    names = sorted(bn.variables)
+    return dict([(v, rnd.choice(bn.variables[v].cpt.values()))
+                 for v in rnd.sample(names, k)])
+
+
+class InferenceTest(unittest.TestCase):
+
+    def assertDistEqual(self, d1, d2, places=9):
+        self.assertEqual(sorted(d1), sorted(d2))
+        for v in d1:
+            self.assertAlmostEqual(d1[v], d2[v], places)
+
+    def impossible(self):
+        """Returns a network in which B = 'f' has probability 0"""
+        a = BayesNet.DiscreteBayesNode('A', [])
+        a.setNodeCPT(BayesNet.DiscreteCPT(['t', 'f'], [0.3, 0.7]))
+        b = BayesNet.DiscreteBayesNode('B', ['A'])
+        b.setNodeCPT(BayesNet.DiscreteCPT(['t', 'f'], {('t',): [1.0, 0.0],
+                                                       ('f',): [1.0, 0.0]}))
+        return BayesNet.DiscreteBayesNet([a, b], 'impossible')
+
+    def test_exact_engines(self):
+        rnd = random.Random(1)
+        for seed in range(4):
+            bn = random_network(7, seed)
+            for trial in range(3):
+                e = random_evidence(bn, rnd, trial)
+                for var in sorted(bn.variables):
+                    expected = brute_posterior(bn, var, e)
+                    for engine in ('elimination', 'junctiontree',
+                                   'enumeration', 'circuit'):
+                        self.assertDistEqual(bn.query_ask(var, e, engine),
+                                             expected)
+
+    def test_all_marginals(self):
+        rnd = random.Random(2)
+        bn = random_network(7, 5)
+        e = random_evidence(bn, rnd, 2)
+        for marginals in (bn.query_all_marginals(e),
+                          bn.query_circuit_marginals(e)):
+            for var in bn.variables:
+                self.assertDistEqual(marginals[var],
+                                     brute_posterior(bn, var, e))
+
+    def test_query_batch(self):
+        rnd = random.Random(3)
+        bn = random_network(7, 6)
+        names = sorted(bn.variables)
+        records = [random_evidence(bn, rnd, rnd.randint(0, 3))
+                   for i in range(20)]
+        for var in names[:3]:
+            data = dict([(v, [r.get(v) for r in records]) for v in names
+                         if v != var])
+            result = bn.query_batch(var, data)
+            levels = bn.variables[var].cpt.values()
+            for row, r in zip(result, records):
+                r = dict([(v, value) for v, value in r.items() if v != var])
+                expected = brute_posterior(bn, var, r)
+                self.assertDistEqual(dict(zip(levels, row.tolist())),
+                                     expected)
+
+    def test_query_map(self):
+        rnd = random.Random(4)
+        for seed in range(3):
+            bn = random_network(7, seed)
+            names = sorted(bn.variables)
+            e = random_evidence(bn, rnd, 2)
+            vars = [v for v in names if v not in e][:2]
+            assignment, p = bn.query_map(vars, e)
+            expected, q = brute_map(bn, vars, e)
+            self.assertEqual(assignment, expected)
+            self.assertAlmostEqual(p, q, 12)
+            assignment, p = bn.query_mpe(e)
+            expected, q = brute_map(bn, names, e)
+            self.assertEqual(assignment, expected)
+            self.assertAlmostEqual(p, q, 12)
+
+    def test_query_map_batch(self):
+        rnd = random.Random(28)
+        bn = random_network(7, 29)
+        names = sorted(bn.variables)
+        vars = names[:2]
+        records = []
+        for i in range(15):
+            r = random_evidence(bn, rnd, rnd.randint(0, 3))
+            records.append(dict([(v, x) for v, x in r.items()
+                                 if v not in vars]))
+        data = dict([(v, [r.get(v) for r in records]) for v in names[2:]])
+        values, probs = bn.query_map_batch(data, vars=vars, chunkSize=4)
+        for row, p, r in zip(values, probs, records):
+            expected, q = brute_map(bn, vars, r)
+            self.assertEqual(dict([(v, bn.variables[v].cpt.values()[c])
+                                   for v, c in zip(vars, row)]), expected)
+            self.assertAlmostEqual(p, q, 12)
+
+    def test_incremental_evidence(self):
+        rnd = random.Random(5)
+        bn = random_network(8, 7)
+        names = sorted(bn.variables)
+        bn.setEvidence({})
+        for step in range(6):
+            v = rnd.choice(names)
+            if v in bn.getEvidence() and rnd.random() < 0.5:
+                bn.retractEvidence(v)
+            else:
+                bn.addEvidence(v, rnd.choice(bn.variables[v].cpt.values()))
+            e = dict(bn.getEvidence())
+            for var in names:
+                self.assertDistEqual(bn.BayesInference(var),
+                                     brute_posterior(bn, var, e))
+
+    def test_fully_observed(self):
+        bn = random_network(5, 8)
+        names = sorted(bn.variables)
+        a, p = next(joint(bn))
+        self.assertEqual(bn.query_map([names[0]], {names[0]: a[names[0]]}),
+                         ({names[0]: a[names[0]]},
+                          bn.query_ve(names[0], {})[a[names[0]]]))
+        assignment, q = bn.query_mpe(a)
+        self.assertEqual(assignment, a)
+        self.assertAlmostEqual(q, p, 12)
+        self.assertEqual(bn.query_map([], {}), ({}, 1.0))
+
+    def test_impossible_evidence(self):
+        bn = self.impossible()
+        zeros = {'t': 0.0, 'f': 0.0}
+        for engine in ('elimination', 'junctiontree', 'enumeration',
+                       'circuit'):
+            self.assertEqual(bn.query_ask('A', {'B': 'f'}, engine), zeros)
+        self.assertEqual(bn.query_map(['A'], {'B': 'f'})[1], 0.0)
+        self.assertEqual(bn.compileCircuit().evaluate({'B': 'f'}), 0.0)
+        dist, diagnostics = bn.query_gibbs('A', {'B': 'f'}, samples=1000,
+                                           workers=1, seed=0)
+        self.assertEqual(dist, zeros)
+        self.assertTrue(diagnostics['impossible'])
+
+    def test_empty_network(self):
+        bn = BayesNet.DiscreteBayesNet([], 'empty')
+        self.assertEqual(bn.query_mpe({}), ({}, 1.0))
+        self.assertEqual(bn.compileCircuit().posteriors({}), (1.0, {}))
+
+    def test_circuit_round_trip(self):
+        rnd = random.Random(6)
+        bn = random_network(7, 9)
+        circuit = bn.compileCircuit()
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('circuit', 'circuit.npz'):
+                filename = os.path.join(directory, name)
+                circuit.save(filename)
+                loaded = BayesNet.load_circuit(filename)
+                for trial in range(3):
+                    e = random_evidence(bn, rnd, trial + 1)
+                    p = sum([q for a, q in joint(bn) if consistent(a, e)])
+                    self.assertAlmostEqual(loaded.evaluate(e), p, 12)
+                    p, marginals = loaded.posteriors(e)
+                    for var in bn.variables:
+                        if var not in e:
+                            self.assertDistEqual(marginals[var],
+                                                 brute_posterior(bn, var, e))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cpt_edits_need_set_node_cpt(self):
+        bn = random_network(5, 10)
+        node = bn.variables['X4']
+        before = bn.query_ask('X4', {})
+        table = node.getNodeCPT()
+        for parentVals in table:
+            table[parentVals] = [1.0] + [0.0] * (len(table[parentVals]) - 1)
+        self.assertEqual(bn.query_ask('X4', {}), before)
+        bn.setNodeCPT(node, BayesNet.DiscreteCPT(node.cpt.values(), table))
+        self.assertDistEqual(bn.query_ask('X4', {}),
+                             brute_posterior(bn, 'X4', {}))
+
+    def test_encode_levels(self):
+        column = np.array([1, 2, None], dtype=object)
+        self.assertEqual(BayesNet.encode_levels(column, [1, 2]).tolist(),
+                         [0, 1, -1])
+        levels = []
+        codes = BayesNet.encode_levels(np.array([1.5, 2.5, 1.5]), levels, True)
+        self.assertEqual(codes.tolist(), [0, 1, 0])
+        self.assertEqual(levels, [1.5, 2.5])
+
+
+class NetworkEvidenceTest(unittest.TestCase):
+
+    def test_network_evidence_queries(self):
+        bn = random_network(6, 13)
+        e = {'X5': bn.variables['X5'].cpt.values()[0]}
+        bn.setEvidence(dict(e))
+        for engine in ('junctiontree', 'elimination', 'enumeration'):
+            bn.engine = engine
+            posterior = bn.BayesInference('X1')
+            expected = brute_posterior(bn, 'X1', e)
+            for v in posterior:
+                self.assertAlmostEqual(posterior[v], expected[v], 9)
+            marginal = bn.getMarginal('X1')
+            expected = brute_posterior(bn, 'X1', {})
+            for v in marginal:
+                self.assertAlmostEqual(marginal[v], expected[v], 9)
+            self.assertEqual(bn.getEvidence(), e)
+
+    def test_result_cache_serves_repeated_queries(self):
+        bn = random_network(6, 14)
+        bn.setEvidence({'X2': bn.variables['X2'].cpt.values()[1]})
+        bn.BayesInference('X4')
+        hits = bn.cacheStats()['hits']
+        bn.BayesInference('X4')
+        self.assertEqual(bn.cacheStats()['hits'], hits + 1)
+
+
+def sample_columns(bn, n, seed, missing=0.0):
+    """Returns n forward samples of the network as a dict of code columns,
+    with the given fraction of entries set to -1"""
+    rows = np.vstack(list(bn.sampleRows(n, seed=seed)))
+    rng = np.random.RandomState(seed)
+    data = {}
+    for j, node in enumerate(bn.nodes):
+        column = rows[:, j].copy()
+        column[rng.rand(n) < missing] = -1
+        data[node.name] = column
+    return data
+
+
+class SamplingTest(unittest.TestCase):
+
+    def test_gibbs_posterior(self):
+        rnd = random.Random(16)
+        bn = random_network(7, 17)
+        for workers in (1, 2):
+            e = random_evidence(bn, rnd, 2)
+            var = [v for v in sorted(bn.variables) if v not in e][-1]
+            dist, diagnostics = bn.query_gibbs(var, e, samples=40000,
+                                               workers=workers, seed=18)
+            expected = brute_posterior(bn, var, e)
+            for v in dist:
+                self.assertTrue(abs(dist[v] - expected[v]) < 0.02)
+            self.assertEqual(diagnostics['chains'], workers * 32)
+            self.assertTrue(diagnostics['samples'] >= 40000)
+            self.assertTrue(diagnostics['rhat'] < 1.1)
+            self.assertEqual(diagnostics['zeroMass'], 0)
+            self.assertFalse(diagnostics['impossible'])
+
+    def test_likelihood_weighting(self):
+        rnd = random.Random(19)
+        bn = random_network(7, 20)
+        for trial in range(3):
+            e = random_evidence(bn, rnd, 2)
+            var = [v for v in sorted(bn.variables) if v not in e][-1]
+            expected = brute_posterior(bn, var, e)
+            dist, diagnostics = bn.query_lw(var, e, samples=50000,
+                                            batchSize=7000, seed=trial)
+            self.assertEqual(diagnostics['samples'], 50000)
+            self.assertTrue(0 < diagnostics['ess'] <= 50000)
+            for v in dist:
+                self.assertTrue(abs(dist[v] - expected[v]) < 0.03)
+            dist, diagnostics = bn.query_lw(var, e, targetError=0.01,
+                                            batchSize=1000, seed=trial)
+            self.assertTrue(diagnostics['stderr'] <= 0.01)
+            self.assertTrue(diagnostics['samples'] < 100000)
+            for v in dist:
+                self.assertTrue(abs(dist[v] - expected[v]) < 0.05)
+
+    def test_forward_sampling(self):
+        bn = random_network(6, 21)
+        batches = list(bn.sampleRows(25000, batchSize=10000, seed=22))
+        self.assertEqual([len(b) for b in batches], [10000, 10000, 5000])
+        rows = np.vstack(batches)
+        self.assertEqual(rows.shape, (25000, len(bn.nodes)))
+        again = np.vstack(list(bn.sampleRows(25000, batchSize=10000,
+                                             seed=22)))
+        self.assertTrue((rows == again).all())
+        for j, node in enumerate(bn.nodes):
+            expected = brute_posterior(bn, node.name, {})
+            counts = np.bincount(rows[:, j],
+                                 minlength=len(node.cpt.values()))
+            for code, value in enumerate(node.cpt.values()):
+                self.assertTrue(abs(counts[code] / 25000.0 -
+                                    expected[value]) < 0.015)
+
+    def test_write_samples_csv(self):
+        bn = random_network(5, 23)
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'samples.csv')
+            bn.writeSamplesCSV(filename, 500, batchSize=200, seed=24)
+            levels = dict([(node.name, node.cpt.values())
+                           for node in bn.nodes])
+            codes, levels, n = BayesNet.encode_table(filename, None, levels)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(n, 500)
+        rows = np.vstack(list(bn.sampleRows(500, batchSize=200, seed=24)))
+        for j, node in enumerate(bn.nodes):
+            self.assertTrue((codes[node.name] == rows[:, j]).all())
+
+    def test_potential_scale_reduction(self):
+        mixed = np.array([[50, 50], [52, 48], [49, 51], [51, 49]])
+        self.assertTrue(BayesNet.potential_scale_reduction(mixed) < 1.05)
+        stuck = np.array([[95, 5], [6, 94], [93, 7], [4, 96]])
+        self.assertTrue(BayesNet.potential_scale_reduction(stuck) > 2)
+
+
+class LoopyBeliefPropagationTest(unittest.TestCase):
+
+    def test_loopy_belief_propagation(self):
+        rnd = random.Random(25)
+        tree = random_network(8, 26, maxParents=1)
+        loopy = random_network(8, 27)
+        for trial in range(3):
+            e = random_evidence(tree, rnd, 2)
+            for schedule in ('synchronous', 'residual'):
+                marginals, diagnostics = tree.query_lbp_marginals(
+                    e, schedule, maxIter=200, tol=1e-10)
+                self.assertTrue(diagnostics['converged'])
+                for var in tree.variables:
+                    expected = brute_posterior(tree, var, e)
+                    for v in expected:
+                        self.assertAlmostEqual(marginals[var][v],
+                                               expected[v], 6)
+            e = random_evidence(loopy, rnd, 1)
+            marginals, diagnostics = loopy.query_lbp_marginals(
+                e, 'residual', damping=0.3, maxIter=500)
+            self.assertTrue(diagnostics['converged'])
+            for var in loopy.variables:
+                expected = brute_posterior(loopy, var, e)
+                for v in expected:
+                    self.assertTrue(abs(marginals[var][v] - expected[v]) < 0.1)
+        self.assertRaises(ValueError, tree.query_lbp_marginals, {}, 'random')
+
+
+class LearningTest(unittest.TestCase):
+
+    rows = [('t', 't'), ('t', 'f'), ('t', 't'), ('f', 'f'), ('f', None),
+            (None, 't'), ('f', 'f'), ('t', 't')]
+
+    def network(self):
+        a = BayesNet.DiscreteBayesNode('A', [])
+        a.setNodeCPT(BayesNet.DiscreteCPT(['t', 'f'], [0.5, 0.5]))
+        b = BayesNet.DiscreteBayesNode('B', ['A'])
+        b.setNodeCPT(BayesNet.DiscreteCPT(['t', 'f'], {('t',): [0.5, 0.5],
+                                                       ('f',): [0.5, 0.5]}))
+        return BayesNet.DiscreteBayesNet([a, b], 'learned')
+
+    def check(self, bn, alpha):
+        a = bn.variables['A'].getNodeCPT()[()]
+        self.assertTrue(np.allclose(a, [(4 + alpha) / (7 + 2 * alpha),
+                                        (3 + alpha) / (7 + 2 * alpha)]))
+        b = bn.variables['B'].getNodeCPT()
+        self.assertTrue(np.allclose(b[('t',)],
+                                    [(3 + alpha) / (4 + 2 * alpha),
+                                     (1 + alpha) / (4 + 2 * alpha)]))
+        self.assertTrue(np.allclose(b[('f',)],
+                                    [alpha / (2 + 2 * alpha),
+                                     (2 + alpha) / (2 + 2 * alpha)]))
+
+    def test_learn_from_chunks(self):
+        chunks = [dict([(v, [r[j] for r in rows]) for j, v in
+                        enumerate('AB')])
+                  for rows in (self.rows[:3], self.rows[3:])]
+        for alpha in (0.0, 1.0):
+            bn = self.network()
+            learner = bn.learnCPTs(chunks, alpha=alpha)
+            self.assertEqual(learner.rows, 8)
+            self.check(bn, alpha)
+
+    def test_learn_from_csv(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'data.csv')
+            f = open(filename, 'wb')
+            f.write('A,B\n')
+            for r in self.rows:
+                f.write(','.join([v or '' for v in r]) + '\n')
+            f.close()
+            bn = self.network()
+            bn.learnCPTs(filename, chunkSize=3, alpha=0.5)
+        finally:
+            shutil.rmtree(directory)
+        self.check(bn, 0.5)
+
+    def test_values_collected_from_data(self):
+        learner = BayesNet.CPTLearner({'X': [], 'Y': ['X']})
+        learner.update({'X': ['a', 'a'], 'Y': ['u', 'v']})
+        learner.update({'X': ['b', 'a'], 'Y': ['w', 'u']})
+        self.assertEqual(learner.levels['X'], ['a', 'b'])
+        self.assertEqual(learner.levels['Y'], ['u', 'v', 'w'])
+        cpts = learner.cpts()
+        self.assertTrue(np.allclose(cpts['X'].probTable[()], [0.75, 0.25]))
+        self.assertTrue(np.allclose(cpts['Y'].probTable[('a',)],
+                                    [2 / 3.0, 1 / 3.0, 0.0]))
+        self.assertTrue(np.allclose(cpts['Y'].probTable[('b',)],
+                                    [0.0, 0.0, 1.0]))
+
+
+class CountIndexTest(unittest.TestCase):
+
+    def brute_counts(self, codes, levels, vars):
+        table = np.zeros([len(levels[v]) for v in vars])
+        for i in range(len(codes[vars[0]])):
+            row = tuple([codes[v][i] for v in vars])
+            if min(row) >= 0:
+                table[row] += 1
+        return table
+
+    def test_counts_match_brute_force(self):
+        rng = np.random.RandomState(30)
+        levels = {'A': ['x', 'y'], 'B': ['x', 'y', 'z'], 'C': ['x', 'y'],
+                  'D': ['x', 'y', 'z', 'w']}
+        codes = dict([(v, rng.randint(len(l), size=400))
+                       for v, l in levels.items()])
+        codes['B'][rng.rand(400) < 0.2] = -1
+        codes['D'][rng.rand(400) < 0.1] = -1
+        index = BayesNet.CountIndex(codes, levels, maxsize=8)
+        self.assertEqual(index.records, 400)
+        self.assertEqual(index.complete, set(['A', 'C']))
+        for vars in (['A', 'B', 'C'], ['B', 'A'], ['C', 'A'], ['A'],
+                     ['B'], ['D', 'B', 'C'], ['C'], ['D', 'A', 'C', 'B']):
+            self.assertTrue((index.counts(vars) ==
+                             self.brute_counts(codes, levels, vars)).all())
+        self.assertEqual(index.counts([]), 400)
+
+    def test_counts_derived_from_cached_tables(self):
+        rng = np.random.RandomState(31)
+        levels = {'A': ['x', 'y'], 'B': ['x', 'y', 'z'], 'C': ['x', 'y']}
+        codes = dict([(v, rng.randint(len(l), size=300))
+                       for v, l in levels.items()])
+        codes['C'][:30] = -1
+        index = BayesNet.CountIndex(codes, levels)
+        index.counts(['A', 'B', 'C'])
+        self.assertTrue(index._derive(('A', 'B')) is None)
+        derived = index._derive(('A', 'C'))
+        self.assertTrue((derived ==
+                         self.brute_counts(codes, levels, ['A', 'C'])).all())
+        self.assertTrue((index.counts(['A', 'B']) ==
+                         self.brute_counts(codes, levels, ['A', 'B'])).all())
+
+
+class EMTest(unittest.TestCase):
+
+    def test_complete_data_gives_counts(self):
+        bn = random_network(5, 20)
+        data = sample_columns(bn, 2000, 1)
+        em = random_network(5, 20)
+        em.learnEM(data, maxIter=2, workers=1)
+        counted = random_network(5, 20)
+        counted.learnCPTs([data])
+        for node in em.nodes:
+            table = counted.variables[node.name].getNodeCPT()
+            for parentVals, probs in node.getNodeCPT().items():
+                self.assertTrue(np.allclose(probs, table[parentVals]))
+
+    def test_log_likelihood_trace(self):
+        bn = random_network(5, 21)
+        data = sample_columns(bn, 300, 2, missing=0.3)
+        names = [node.name for node in bn.nodes]
+        expected = 0.0
+        for i in range(300):
+            e = dict([(v, bn.variables[v].cpt.values()[data[v][i]])
+                      for v in names if data[v][i] >= 0])
+            expected += np.log(sum([p for a, p in joint(bn)
+                                    if consistent(a, e)]))
+        trace = bn.learnEM(data, maxIter=10, workers=1, tol=0.0)
+        self.assertAlmostEqual(trace[0], expected, 8)
+        for before, after in zip(trace, trace[1:]):
+            self.assertTrue(after >= before - 1e-9)
+
+    def test_workers_and_checkpoint_resume(self):
+        data = sample_columns(random_network(5, 22), 1000, 3, missing=0.2)
+        serial = random_network(5, 22)
+        trace = serial.learnEM(data, maxIter=4, workers=1, tol=0.0)
+        parallel = random_network(5, 22)
+        self.assertTrue(np.allclose(parallel.learnEM(data, maxIter=4,
+                                                     workers=2, tol=0.0),
+                                    trace))
+        directory = tempfile.mkdtemp()
+        try:
+            checkpoint = os.path.join(directory, 'em.ck')
+            resumed = random_network(5, 22)
+            resumed.learnEM(data, maxIter=2, workers=1, tol=0.0,
+                            checkpoint=checkpoint)
+            resumed = random_network(5, 22)
+            self.assertTrue(np.allclose(
+                resumed.learnEM(data, maxIter=4, workers=1, tol=0.0,
+                                checkpoint=checkpoint), trace))
+        finally:
+            shutil.rmtree(directory)
+        for node in serial.nodes:
+            table = resumed.variables[node.name].getNodeCPT()
+            for parentVals, probs in node.getNodeCPT().items():
+                self.assertTrue(np.allclose(probs, table[parentVals]))
+
+
+class StructureSearchTest(unittest.TestCase):
+
+    def chain_data(self, n, seed):
+        a = BayesNet.DiscreteBayesNode('A', [])
+        a.setNodeCPT(BayesNet.DiscreteCPT(['t', 'f'], [0.5, 0.5]))
+        b = BayesNet.DiscreteBayesNode('B', ['A'])
+        b.setNodeCPT(BayesNet.DiscreteCPT(['t', 'f'], {('t',): [0.9, 0.1],
+                                                ('f',): [0.2, 0.8]}))
+        c = BayesNet.DiscreteBayesNode('C', ['B'])
+        c.setNodeCPT(BayesNet.DiscreteCPT(['t', 'f'], {('t',): [0.85, 0.15],
+                                                ('f',): [0.1, 0.9]}))
+        d = BayesNet.DiscreteBayesNode('D', [])
+        d.setNodeCPT(BayesNet.DiscreteCPT(['t', 'f'], [0.3, 0.7]))
+        return sample_columns(BayesNet.DiscreteBayesNet([a, b, c, d], 'chain'), n, seed)
+
+    def skeleton(self, parents):
+        return set([frozenset((p, v)) for v in parents for p in parents[v]])
+
+    def test_bic_local_score(self):
+        data = self.chain_data(500, 4)
+        search = BayesNet.StructureSearch(data, dict([(v, ['t', 'f'])
+                                               for v in data]))
+        counts = np.zeros((2, 2))
+        for a, b in zip(data['A'], data['B']):
+            counts[a, b] += 1
+        expected = sum([counts[i, j] * np.log(counts[i, j] / counts[i].sum())
+                        for i in range(2) for j in range(2)])
+        expected -= 0.5 * np.log(500) * 2
+        self.assertAlmostEqual(search.localScore('B', ['A']), expected, 8)
+
+    def test_search_recovers_skeleton(self):
+        data = self.chain_data(3000, 5)
+        levels = dict([(v, ['t', 'f']) for v in data])
+        for score in ('bic', 'bdeu'):
+            search = BayesNet.StructureSearch(data, levels, score)
+            climbed, climbedScore = search.search('hill-climbing')
+            self.assertEqual(self.skeleton(climbed),
+                             set([frozenset('AB'), frozenset('BC')]))
+            self.assertAlmostEqual(search.totalScore(climbed),
+                                   climbedScore, 6)
+            tabu, tabuScore = search.search('tabu')
+            self.assertTrue(tabuScore >= climbedScore - 1e-9)
+            self.assertRaises(ValueError, search.search, 'anneal')
+
+    def test_learn_structure(self):
+        data = self.chain_data(3000, 6)
+        serial = BayesNet.learn_structure(data, workers=1)
+        parallel = BayesNet.learn_structure(data, workers=2)
+        parents = dict([(node.name, node.parents) for node in serial.nodes])
+        self.assertEqual(self.skeleton(parents),
+                         set([frozenset('AB'), frozenset('BC')]))
+        for node in serial.nodes:
+            self.assertEqual(node.parents,
+                             parallel.variables[node.name].parents)
+            for parentVals, probs in node.getNodeCPT().items():
+                self.assertAlmostEqual(sum(probs), 1.0)
+
+
+class ExecutorTest(unittest.TestCase):
+
+    def check_executor(self, executor):
+        rnd = random.Random(13)
+        bn = random_network(8, 14)
+        bn.executor = executor
+        bn.executorWorkers = 3
+        bn.executorCutoff = 0
+        bn.useEnumerationMemo(1000)
+        try:
+            for trial in range(3):
+                e = random_evidence(bn, rnd, 2)
+                for var in sorted(bn.variables):
+                    dist = bn.query_ask(var, e, 'enumeration')
+                    expected = brute_posterior(bn, var, e)
+                    for v in dist:
+                        self.assertAlmostEqual(dist[v], expected[v], 9)
+            pool = bn._pool[1]
+            bn.query_ask('X7', {}, 'enumeration')
+            self.assertTrue(bn._pool[1] is pool)
+            node = bn.variables['X0']
+            certain = [1.0] + [0.0] * (len(node.cpt.values()) - 1)
+            bn.setNodeCPT(node, BayesNet.DiscreteCPT(node.cpt.values(),
+                                                     certain))
+            dist = bn.query_ask('X7', {}, 'enumeration')
+            expected = brute_posterior(bn, 'X7', {})
+            for v in dist:
+                self.assertAlmostEqual(dist[v], expected[v], 9)
+            self.assertEqual(bn._pool[1] is pool, executor == 'thread')
+        finally:
+            bn.close()
+        self.assertTrue(bn._pool is None)
+
+    def test_thread_executor(self):
+        self.check_executor('thread')
+
+    def test_process_executor(self):
+        self.check_executor('process')
+
+    def test_unknown_executor(self):
+        bn = random_network(4, 15)
+        bn.executor = 'cluster'
+        bn.executorCutoff = 0
+        self.assertRaises(ValueError, bn.query_ask, 'X3', {}, 'enumeration')
+
+
+class EncodeLevelsTest(unittest.TestCase):
+
+    def test_integer_levels_are_matched_as_values(self):
+        codes = BayesNet.encode_levels(np.array([2, 1, -1]), [1, 2])
+        self.assertEqual(codes.tolist(), [1, 0, -1])
+        self.assertRaises(ValueError, BayesNet.encode_levels,
+                          np.array([3]), [1, 2])
+
+    def test_integer_codes_are_range_checked(self):
+        codes = BayesNet.encode_levels(np.array([1, 0, -1]), ['t', 'f'])
+        self.assertEqual(codes.tolist(), [1, 0, -1])
+        for bad in (2, -2):
+            self.assertRaises(ValueError, BayesNet.encode_levels,
+                              np.array([bad]), ['t', 'f'])
+        levels = []
+        BayesNet.encode_levels(np.array([0, 3, -1]), levels, True)
+        self.assertEqual(levels, [0, 1, 2, 3])
+
+    def test_query_batch_with_integer_levels(self):
+        a = BayesNet.DiscreteBayesNode('A', [])
+        a.setNodeCPT(BayesNet.DiscreteCPT([1, 2], [0.5, 0.5]))
+        b = BayesNet.DiscreteBayesNode('B', ['A'])
+        b.setNodeCPT(BayesNet.DiscreteCPT(['t', 'f'], {(1,): [0.9, 0.1],
+                                                       (2,): [0.2, 0.8]}))
+        bn = BayesNet.DiscreteBayesNet([a, b], 'x')
+        result = bn.query_batch('B', {'A': np.array([1, 2])})
+        self.assertTrue(np.allclose(result, [[0.9, 0.1], [0.2, 0.8]]))
+
+
+class CompactTest(unittest.TestCase):
+
+    def test_compact_keeps_answers(self):
+        rnd = random.Random(8)
+        bn = random_network(7, 18)
+        tables = dict([(node.name, node.getNodeCPT()) for node in bn.nodes])
+        e = random_evidence(bn, rnd, 2)
+        expected = bn.query_all_marginals(e)
+        bn.compact()
+        for node in bn.nodes:
+            self.assertTrue(isinstance(node.cpt, BayesNet.CompactCPT))
+            view = node.getNodeCPT()
+            self.assertEqual(sorted(view), sorted(tables[node.name]))
+            for parentVals, probs in tables[node.name].items():
+                self.assertEqual(view[parentVals], probs)
+        marginals = bn.query_all_marginals(e)
+        for var in bn.variables:
+            for v in marginals[var]:
+                self.assertAlmostEqual(marginals[var][v], expected[var][v], 12)
+        copy = cPickle.loads(cPickle.dumps(bn, 2))
+        self.assertEqual(copy.variables['X3'].getNodeCPT(),
+                         bn.variables['X3'].getNodeCPT())
+
+    def test_set_levels_of_compact_node(self):
+        bn = random_network(4, 19)
+        bn.compact()
+        node = bn.variables['X3']
+        levels = ['v%d' % i for i in range(len(node.cpt.values()))]
+        node.setNodeLevels(levels)
+        self.assertFalse(isinstance(node.cpt, BayesNet.CompactCPT))
+        self.assertEqual(sorted(bn.query_ask('X3', {})), sorted(levels))
+        node.setNodeLevels(levels + ['extra'])
+        table = dict([(k, list(p) + [0.0])
+                      for k, p in node.getNodeCPT().items()])
+        bn.setNodeCPT(node, BayesNet.DiscreteCPT(node.cpt.values(), table))
+        self.assertEqual(bn.query_ask('X3', {})['extra'], 0.0)
+
+
+class ModelKeyTest(unittest.TestCase):
+
+    def test_changes_reach_only_their_network(self):
+        a = random_network(5, 15)
+        b = random_network(5, 16)
+        compiledA, compiledB = a.compile(), b.compile()
+        node = b.variables['X3']
+        b.setNodeCPT(node, BayesNet.DiscreteCPT(node.cpt.values(),
+                                                node.getNodeCPT()))
+        self.assertTrue(a.compile() is compiledA)
+        self.assertFalse(b.compile() is compiledB)
+        node = a.variables['X1']
+        node.setNodeCPT(BayesNet.DiscreteCPT(node.cpt.values(),
+                                             node.getNodeCPT()))
+        self.assertFalse(a.compile() is compiledA)
+
+    def test_deleted_node_is_not_watched(self):
+        bn = random_network(5, 17)
+        bn.compile()
+        leaf = [node for node in bn.nodes if not bn.getChildren(node)][0]
+        bn.deleteNode(leaf)
+        compiled = bn.compile()
+        leaf.setNodeLevels(leaf.cpt.values())
+        self.assertTrue(bn.compile() is compiled)
+
+
+class EnumerationMemoTest(unittest.TestCase):
+
+    def test_memo_matches_brute_force(self):
+        rnd = random.Random(7)
+        bn = random_network(7, 11)
+        bn.useEnumerationMemo(1000)
+        for trial in range(4):
+            e = random_evidence(bn, rnd, 2)
+            for var in sorted(bn.variables):
+                dist = bn.query_ask(var, e, 'enumeration')
+                expected = brute_posterior(bn, var, e)
+                for v in dist:
+                    self.assertAlmostEqual(dist[v], expected[v], 9)
+        self.assertTrue(bn.enumerationMemo.hits > 0)
+
+    def test_query_all_sees_model_changes(self):
+        bn = random_network(4, 12)
+        bn.useEnumerationMemo(1000)
+        node = bn.variables['X0']
+        value = node.cpt.values()[0]
+        e = {'X0': value}
+        p = bn.query_all(bn.variables.keys(), e)
+        self.assertAlmostEqual(p, node.cpt.prob_dist(())[value], 12)
+        certain = [1.0] + [0.0] * (len(node.cpt.values()) - 1)
+        bn.setNodeCPT(node, BayesNet.DiscreteCPT(node.cpt.values(), certain))
+        self.assertAlmostEqual(bn.query_all(bn.variables.keys(), e), 1.0, 12)
+
+
+class IndexTest(unittest.TestCase):
+
+    def node(self, name, parents):
+        node = BayesNet.DiscreteBayesNode(name, parents)
+        table = {}
+        for parentVals in itertools.product(*[['t', 'f'] for p in parents]):
+            table[parentVals] = ([0.9, 0.1] if 't' in parentVals
+                                 else [0.2, 0.8])
+        node.setNodeCPT(BayesNet.DiscreteCPT(['t', 'f'], table))
+        return node
+
+    def assertTopological(self, bn):
+        order = bn.topologicalOrder()
+        self.assertEqual(sorted(order), sorted(bn.variables))
+        for node in bn.nodes:
+            for p in node.parents:
+                self.assertTrue(order.index(p) < order.index(node.name))
+
+    def test_parent_added_after_child(self):
+        bn = BayesNet.DiscreteBayesNet([], 'x')
+        bn.addNode(self.node('C', ['A']))
+        bn.topologicalOrder()
+        bn.addNode(self.node('A', []))
+        self.assertEqual(bn.topologicalOrder(), ['A', 'C'])
+        self.assertAlmostEqual(bn.query_ask('C', {})['t'],
+                               0.2 * 0.9 + 0.8 * 0.2)
+
+    def test_indexes_follow_edits(self):
+        a, b = self.node('A', []), self.node('B', ['A'])
+        c = self.node('C', ['A', 'B'])
+        bn = BayesNet.DiscreteBayesNet([c, a, b], 'x')
+        self.assertTopological(bn)
+        self.assertEqual(sorted(bn.getChildren(a)), ['B', 'C'])
+        self.assertEqual(bn.getParents(c), ['A', 'B'])
+        d = self.node('D', ['C'])
+        bn.addNode(d)
+        self.assertTopological(bn)
+        self.assertEqual(bn.getChildren(c), ['D'])
+        bn.deleteNode(d)
+        self.assertEqual(bn.getChildren(c), [])
+        self.assertTopological(bn)
+        bn.changeNodeName(b, 'E')
+        self.assertEqual(bn.getParents(c), ['A', 'E'])
+        self.assertTopological(bn)
+
+    def test_cycle(self):
+        bn = BayesNet.DiscreteBayesNet([self.node('A', ['B']),
+                                        self.node('B', ['A'])], 'x')
+        self.assertRaises(ValueError, bn.topologicalOrder)
+
+
+if __name__ == '__main__':
+    unittest.main()